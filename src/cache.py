@@ -0,0 +1,124 @@
+'''
+This module provides a size bounded, content addressed file cache.
+'''
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+# Read input files in 1 MB blocks while hashing
+BLOCK_SIZE = 1 << 20
+
+
+def content_key(paths, params) -> str:
+    '''
+    Returns a hex digest of the content of the files in paths and of the
+    JSON serializable params. Any change of an input file or parameter
+    gives a new key.
+    '''
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            block = f.read(BLOCK_SIZE)
+            while block:
+                digest.update(block)
+                block = f.read(BLOCK_SIZE)
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FileCache(object):
+    '''
+    Keeps one file per key under root. When the total size exceeds
+    max_bytes, the least recently used files are evicted.
+    '''
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str, suffix: str = '') -> str:
+        return os.path.join(self.root, key + suffix)
+
+    def get(self, key: str, suffix: str = ''):
+        '''
+        Returns the cached file path of key, or None on a miss.
+        '''
+        path = self.path(key, suffix)
+        try:
+            # The modification time tracks the last use for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key: str, src_path: str, suffix: str = '') -> str:
+        '''
+        Copies src_path into the cache under key and returns the cached path.
+        '''
+        path = self.path(key, suffix)
+        tmp_path = os.path.join(self.root, '.' + uuid.uuid4().hex + '.tmp')
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def get_array(self, key: str):
+        '''
+        Returns the cached array of key, or None on a miss.
+        '''
+        path = self.get(key, '.npy')
+        if path is None:
+            return None
+        try:
+            return np.load(path)
+        except FileNotFoundError:
+            # Evicted by another process after get()
+            return None
+
+    def put_array(self, key: str, arr: np.ndarray) -> str:
+        '''
+        Saves arr into the cache under key and returns the cached path.
+        '''
+        path = self.path(key, '.npy')
+        tmp_path = os.path.join(self.root, '.' + uuid.uuid4().hex + '.npy')
+        np.save(tmp_path, arr)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the cache fits in
+        max_bytes.
+        '''
+        entries = list()
+        total = 0
+        for name in os.listdir(self.root):
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                # Already evicted by another process
+                pass
+            total -= size
@@ -1,112 +1,243 @@
 # Standard library imports.
-from datetime import timedelta, datetime
+from datetime import datetime
+import argparse
+import calendar
+import functools
 import pprint
 import pickle
 import json
+import shutil
 
 # Related third party imports.
 import numpy as np
-from scipy.interpolate import interp1d
-import pandas as pd
 
 # Local application/library specific imports.
 from cerebralcortex.cerebralcortex import CerebralCortex
+from cache import content_key
+import sensors
 import utils
+import validation
 
-def data_filter(input_array: np.ndarray, start_hr: int, end_hr: int):
+def work_hours_mask(ts: np.ndarray, offset: np.ndarray, start_hr: int, end_hr: int):
+    'Returns a boolean mask of timestamps whose local hour is between start_hr and end_hr'
+    local_t = np.floor(ts + offset).astype(np.int64)
+    hour = (local_t // 3600) % 24
+    return (hour >= start_hr) & (hour < end_hr)
+
+
+def data_filter(input_array: np.ndarray, start_hr: int, end_hr: int, mask=None):
     'Keep data rows which are between start_hr and end_hr'
-    output_array = list()
-    for row in input_array:
-        ts = row[0]
-        offset = row[2]
-        dt = datetime.utcfromtimestamp(ts) + timedelta(seconds=offset)
-        if dt.hour >= start_hr and dt.hour < end_hr:
-            output_array.append(row)
-    return np.vstack(output_array)
+    if mask is None:
+        mask = work_hours_mask(input_array[:, 0], input_array[:, 2],
+                               start_hr, end_hr)
+    return input_array[mask]
+
+
+def to_timestamp(t):
+    'Converts a datetime to a UTC timestamp, naive datetimes are taken as UTC'
+    if isinstance(t, datetime):
+        return calendar.timegm(t.utctimetuple()) + t.microsecond / 1e6
+    return float(t)
+
 
+def interval_labels(ts: np.ndarray, intervals, length=None, overlap=0):
+    '''
+    Returns 1.0 for every timestamp of the sorted ts which falls in any of the
+    closed (start, end) intervals, 0.0 otherwise. Intervals may overlap.
+    With a window length (and overlap) in samples, returns the fraction of
+    labeled timestamps of every window utils.generate_wins(view=True) would
+    output instead.
+    '''
+    marks = np.zeros(ts.shape[0] + 1, dtype=np.int64)
+    bounds = np.array([[to_timestamp(start_t), to_timestamp(end_t)]
+                       for start_t, end_t in intervals]).reshape((-1, 2))
+    bounds = bounds[bounds[:, 0] <= bounds[:, 1]]
+    # +1 at the first sample of each interval, -1 after its last sample
+    np.add.at(marks, np.searchsorted(ts, bounds[:, 0], side='left'), 1)
+    np.add.at(marks, np.searchsorted(ts, bounds[:, 1], side='right'), -1)
+    labels = (np.cumsum(marks[:-1]) > 0).astype(np.float64)
+    if length is None:
+        return labels
+    return utils.window_fractions(labels, length, overlap)
 
-def resample(x, ts_new):
+
+def zero_hold_index(ts: np.ndarray, ts_new: np.ndarray):
+    'Returns the index of the latest sample in ts at or before each of ts_new'
+    idx = np.searchsorted(ts, ts_new, side='right') - 1
+    if idx[0] < 0 or ts_new[-1] > ts[-1]:
+        raise ValueError('ts_new is out of the sample time range.')
+    return idx
+
+
+def resample(x, ts_new, idx=None):
     'Resamples x with freq from start_t to end_t'
-    
-    f_new = interp1d(x[:, 0], x[:, 1:], kind='zero', axis=0)
-    
-    x_new = np.hstack((ts_new.reshape((-1, 1)), f_new(ts_new)))
+    if idx is None:
+        idx = zero_hold_index(x[:, 0], ts_new)
+
+    x_new = np.empty((ts_new.shape[0], x.shape[1]))
+    x_new[:, 0] = ts_new
+    np.take(x[:, 1:], idx, axis=0, out=x_new[:, 1:], mode='clip')
     return x_new
 
+
+def resample_all(sensors: dict, ts_new: np.ndarray):
+    '''
+    Resamples every sensor array in sensors onto ts_new with zero order hold.
+    Returns a dict of resampled arrays and a dict with the number of points
+    of ts_new which had to repeat the previous sample of each sensor.
+    '''
+    resampled = dict()
+    filled = dict()
+    for name, x in sensors.items():
+        idx = zero_hold_index(x[:, 0], ts_new)
+        resampled[name] = resample(x, ts_new, idx)
+        filled[name] = int(np.count_nonzero(idx[1:] == idx[:-1]))
+    return resampled, filled
+
 # Set important paths
 CONFIG_PATH = '../config/'
 DATA_PATH = '../data/'
 
-# Load all user IDs
-with open(CONFIG_PATH+'users.json', 'r') as f:
-    USR_IDS = json.load(f)
+# Work hours in local time
+WORK_START_HR = 8
+WORK_END_HR = 20
+
+# Bump when preprocess_day() changes its output for the same inputs
+PREPROCESS_VERSION = 1
 
-# Load all users' work days
-with open(DATA_PATH+'usr_work_days.pkl', 'rb') as f:
-    USR_WORK_DAYS = pickle.load(f)
-    
-# Load all users' groundthruths
-with open(DATA_PATH+'at_desk_groundtruth.pkl', 'rb') as f:
-    AT_DESK_TIMES = pickle.load(f)
+SENSOR_FILES = sensors.resampled_sensors()
 
 
-for usr_id in USR_WORK_DAYS:
+def export_user(CC, usr_id, days):
+    '''
+    Fetches the stream of every resampled sensor of a user from
+    CerebralCortex and saves the valid samples of the given days to
+    <sensor><day>.npz, the input of preprocess_day().
+    '''
     usr_path = DATA_PATH+usr_id+'/'
-    for day in USR_WORK_DAYS[usr_id]:
+    for name in SENSOR_FILES:
+        sensor = sensors.SENSORS[name]
+        print('Exporting '+usr_id+' '+sensor.stream)
+        utils.export_stream(
+            CC, usr_id, sensor.stream, usr_path + name, days,
+            len(sensor.fields),
+            functools.partial(validation.validate_sensor, sensor=name))
 
-        accel = np.load(usr_path+'accel'+day+'.npz')['arr_0']
-        act_type = np.load(usr_path+'act_type'+day+'.npz')['arr_0']
-        gyro = np.load(usr_path+'gyro'+day+'.npz')['arr_0']
-        step_cnt = np.load(usr_path+'step_cnt'+day+'.npz')['arr_0']
 
-        # Find the latest start time among all sensors
-        start_t = max([accel[0][0], act_type[0][0], 
-                       gyro[0][0], step_cnt[0][0]])
-        
-        # Find the earliest end time among all sensors
-        end_t = min([accel[-1][0], act_type[-1][0], 
-                     gyro[-1][0], step_cnt[-1][0]])
-        
-        # Generate new timestamps
-        ts_new = np.arange(start_t, end_t, 1.0/utils.INTERP_FREQ)
- 
-        # Prepare labels for each sensor data point
-        df = pd.DataFrame({'val' : np.zeros(ts_new.shape)},
-                          index=pd.to_datetime(ts_new, unit='s'))
-  
-        for start_t, end_t in AT_DESK_TIMES[usr_id]:
-            df[start_t : end_t] = 1
-        
-        
-        accel = data_filter(resample(accel, ts_new), 8, 20)
-        offset = accel[:, 2]
-        act_type = data_filter(resample(act_type, ts_new), 8, 20)
-        gyro = data_filter(resample(gyro, ts_new), 8, 20)
-        step_cnt  = data_filter(resample(step_cnt, ts_new), 8, 20)
-        
-        
-        ts_new = accel[:, 0]
-        # Prepare labels for each sensor data point
-        df = pd.DataFrame({'val' : np.zeros(ts_new.shape)},
-                          index=pd.to_datetime(ts_new, unit='s'))
-        for start_t, end_t in AT_DESK_TIMES[usr_id]:
-            df[start_t : end_t] = 1
-        labels = np.asarray(df.values).reshape(-1)
+def preprocess_key(usr_id, day, at_desk_times):
+    '''
+    Returns the cache key of a user day from its input files and the
+    preprocessing parameters.
+    '''
+    usr_path = DATA_PATH+usr_id+'/'
+    paths = [usr_path+name+day+'.npz' for name in SENSOR_FILES]
+    params = {'version': PREPROCESS_VERSION,
+              'interp_freq': utils.INTERP_FREQ,
+              'work_hours': [WORK_START_HR, WORK_END_HR],
+              'at_desk_times': [[to_timestamp(start_t), to_timestamp(end_t)]
+                                for start_t, end_t in at_desk_times]}
+    return content_key(paths, params)
+
+
+def preprocess_day(usr_id, day, at_desk_times, cache=None):
+    '''
+    Resamples and filters one day of a user and saves data<day>.npz.
+    With a FileCache, unchanged days are copied from the cache instead.
+    Returns the output filename.
+    '''
+    usr_path = DATA_PATH+usr_id+'/'
+    output_fn = usr_path + 'data' + day + '.npz'
+    if cache is not None:
+        key = preprocess_key(usr_id, day, at_desk_times)
+        cached_fn = cache.get(key, '.npz')
+        if cached_fn is not None:
+            try:
+                shutil.copyfile(cached_fn, output_fn)
+                print('Cache hit for '+output_fn)
+                return output_fn
+            except FileNotFoundError:
+                # Evicted by another process after get(), recompute the day
+                pass
+
+    raw = {name: np.load(usr_path+name+day+'.npz')['arr_0']
+           for name in SENSOR_FILES}
+
+    # Find the latest start time among all sensors
+    start_t = max([x[0][sensors.TS_COL] for x in raw.values()])
+
+    # Find the earliest end time among all sensors
+    end_t = min([x[-1][sensors.TS_COL] for x in raw.values()])
+
+    # Generate new timestamps
+    ts_new = np.arange(start_t, end_t, 1.0/utils.INTERP_FREQ)
+
+    resampled, filled = resample_all(raw, ts_new)
+    for name in sorted(filled):
+        print('%s %s %s: %d of %d points forward filled'
+              % (usr_id, day, name, filled[name], ts_new.shape[0]))
+
+    # All sensors share ts_new, so one work hours mask filters all of them
+    offset = resampled[SENSOR_FILES[0]][:, sensors.OFFSET_COL]
+    mask = work_hours_mask(ts_new, offset, WORK_START_HR, WORK_END_HR)
+    filtered = {name: data_filter(x, WORK_START_HR, WORK_END_HR, mask)
+                for name, x in resampled.items()}
+    offset = offset[mask]
+    ts_new = ts_new[mask]
+
+    # Prepare labels for each sensor data point
+    labels = interval_labels(ts_new, at_desk_times)
+
+    for x in filtered.values():
+        assert(ts_new.shape[0] == x.shape[0])
+    assert(ts_new.shape[0] == labels.shape[0])
+
+    print('Saving '+output_fn+'...')
+
+    np.savez(output_fn,
+             ts=ts_new,
+             offset=offset,
+             labels=labels,
+             **{name: x[:, sensors.sample_cols(name)]
+                for name, x in filtered.items()})
+    if cache is not None:
+        cache.put(key, output_fn, '.npz')
+    return output_fn
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Resample and filter all users\' work days.')
+    utils.add_driver_arguments(
+        parser, 'reuse unchanged days from this cache directory')
+    parser.add_argument('--cc-config',
+                        help='first export the sensor streams of the work '
+                             'days from CerebralCortex with this '
+                             'configuration file')
+    args = parser.parse_args()
+    cache = utils.open_cache(args)
+
+    # Load all user IDs
+    with open(CONFIG_PATH+'users.json', 'r') as f:
+        USR_IDS = json.load(f)
+
+    # Load all users' work days
+    with open(DATA_PATH+'usr_work_days.pkl', 'rb') as f:
+        USR_WORK_DAYS = pickle.load(f)
         
-        assert(ts_new.shape[0] == accel.shape[0])
-        assert(ts_new.shape[0] == act_type.shape[0])
-        assert(ts_new.shape[0] == gyro.shape[0])
-        assert(ts_new.shape[0] == step_cnt.shape[0])
-        assert(ts_new.shape[0] == labels.shape[0])
-
-        output_fn = usr_path + 'data' + day + '.npz'
-        print('Saving '+output_fn+'...')
-
-        np.savez(output_fn,
-                 ts=ts_new,
-                 offset=offset,
-                 accel=accel[:, 3:],
-                 act_type=act_type[:, 3:],
-                 gyro=gyro[:, 3:],
-                 step_cnt=step_cnt[:, 3:],
-                 labels=labels)
+    # Load all users' groundthruths
+    with open(DATA_PATH+'at_desk_groundtruth.pkl', 'rb') as f:
+        AT_DESK_TIMES = pickle.load(f)
+
+    if args.cc_config is not None:
+        CC = CerebralCortex(args.cc_config)
+        for usr_id in USR_WORK_DAYS:
+            export_user(CC, usr_id, USR_WORK_DAYS[usr_id])
+
+    tasks = [(usr_id, day, (AT_DESK_TIMES[usr_id],))
+             for usr_id in USR_WORK_DAYS
+             for day in USR_WORK_DAYS[usr_id]]
+    utils.run_day_tasks(preprocess_day, tasks, args.workers, cache)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+'''
+This module provides a long running at desk detector. Sensor samples of
+many users arrive as JSON lines over a local TCP socket or stdin, and an
+at desk decision is emitted for every user as soon as a window closes.
+The window and the model input follow the model width: 2s windows of raw
+samples for the shipped model, 10s windows of L2 normalized features for a
+feature model. A gap in the samples of a user drops the partial window.
+
+Input message, one JSON object per line, samples on the INTERP_FREQ grid:
+    {"user": "<usr_id>", "ts": [...], "offset": [...],
+     "accel": [[x, y, z], ...], "gyro": [[x, y, z], ...],
+     "step_cnt": [...], "act_type": [...]}
+    {"cmd": "stats"}
+Output message for every closed window:
+    {"user": "<usr_id>", "ts": <window start>, "prob": <at desk prob>,
+     "at_desk": true|false, "latency_ms": <ms>}
+With --smooth, decisions also carry the hysteresis state as "session" and
+every finished at desk session is emitted as
+    {"user": "<usr_id>", "start": <ts>, "end": <ts>}
+'''
+# Standard library imports.
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Related third party imports.
+import numpy as np
+
+# Local application/library specific imports.
+import feature_extraction
+import inference
+import utils
+from smoothing import HysteresisSmoother
+from streaming import StreamingFeatureExtractor, buffer_layout
+
+HOST = '127.0.0.1'
+PORT = 8765
+THRESHOLD = 0.5
+# Number of recent decisions kept for the latency percentiles
+LATENCY_SAMPLES = 10000
+# Longest accepted input line in bytes
+LINE_LIMIT = 16 * 2**20
+# Samples further apart than this many INTERP_FREQ steps are a gap
+GAP_STEPS = 1.5
+
+
+def model_windows(model_input: str) -> tuple:
+    '''
+    Returns the window length in seconds and the buffered sample fields of
+    every sensor the model input is computed from.
+    '''
+    if model_input == 'raw':
+        sensor_cols = collections.OrderedDict()
+        for name, field in inference.RAW_CHANNELS:
+            sensor_cols[name] = max(sensor_cols.get(name, 0), field + 1)
+        return inference.RAW_WIN_SIZE, sensor_cols
+    return feature_extraction.WIN_SIZE, None
+
+
+def parse_samples(msg: dict, cols: dict) -> tuple:
+    '''
+    Checks a sample message before any user state is touched.
+    Return:
+        (usr_id, ts, offset, dict of the samples of every sensor of cols)
+    '''
+    usr_id = msg['user']
+    if not isinstance(usr_id, str):
+        raise ValueError('user must be a string.')
+    ts = np.asarray(msg['ts'], dtype=np.float64)
+    if ts.ndim != 1 or not ts.shape[0]:
+        raise ValueError('ts must be a non empty list.')
+    if np.any(np.diff(ts) <= 0):
+        raise ValueError('ts must be increasing.')
+    offset = np.asarray(msg['offset'], dtype=np.float64)
+    if offset.shape != ts.shape:
+        raise ValueError('offset has %d samples, ts has %d.'
+                         % (offset.size, ts.shape[0]))
+    sensor_data = dict()
+    for name, sensor_cols in cols.items():
+        x = np.asarray(msg[name], dtype=np.float64)
+        if not x.ndim or x.shape[0] != ts.shape[0]:
+            raise ValueError('%s has %d samples, ts has %d.'
+                             % (name, x.shape[0] if x.ndim else 0,
+                                ts.shape[0]))
+        x = x.reshape((ts.shape[0], -1))
+        n_cols = sensor_cols.stop - sensor_cols.start
+        if x.shape[1] < n_cols:
+            raise ValueError('%s samples have %d fields, %d expected.'
+                             % (name, x.shape[1], n_cols))
+        sensor_data[name] = x
+    return usr_id, ts, offset, sensor_data
+
+
+class Detector(object):
+    '''
+    Keeps one StreamingFeatureExtractor per user and scores every closed
+    window with the NumPy DNN forward pass. The model input is picked by
+    the model width: the raw samples of 2s windows (inference.RAW_CHANNELS)
+    or the L2 normalized features of 10s windows.
+    '''
+
+    def __init__(self, layers, threshold=THRESHOLD, normalize=True,
+                 smooth=False, sample_freq=utils.INTERP_FREQ):
+        n_inputs = layers[0][0].shape[0]
+        self.model_input = inference.model_input(n_inputs)
+        if self.model_input is None:
+            raise ValueError('the model expects %d inputs, neither raw '
+                             'windows (%d) nor features (%d).'
+                             % (n_inputs, inference.RAW_INPUT_DIM,
+                                inference.feature_input_dim()))
+        self.t_win, self.sensor_cols = model_windows(self.model_input)
+        self.cols, _ = buffer_layout(self.sensor_cols)
+        self.layers = layers
+        self.threshold = threshold
+        self.normalize = (normalize
+                          and self.model_input in inference.NORMALIZED_INPUTS)
+        self.smooth = smooth
+        self.sample_freq = sample_freq
+        # Consecutive samples further apart than this start a new stream
+        self.max_step = GAP_STEPS / sample_freq
+        self.extractors = dict()
+        self.smoothers = dict()
+        self.last_ts = dict()
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def handle(self, msg: dict) -> list:
+        '''
+        Processes one input message and returns the output messages.
+        '''
+        if not isinstance(msg, dict):
+            raise ValueError('message must be a JSON object.')
+        if msg.get('cmd') == 'stats':
+            return [self.latency_stats()]
+
+        start = time.time()
+        usr_id, ts, offset, sensor_data = parse_samples(msg, self.cols)
+        if usr_id not in self.extractors:
+            self.extractors[usr_id] = StreamingFeatureExtractor(
+                self.sample_freq, self.t_win, outlier_mode='clip',
+                sensor_cols=self.sensor_cols)
+            if self.smooth:
+                self.smoothers[usr_id] = HysteresisSmoother(t_win=self.t_win)
+
+        out = list()
+        last_ts = self.last_ts.get(usr_id)
+        if last_ts is not None and not 0 < ts[0] - last_ts <= self.max_step:
+            out.extend(self.restart(usr_id))
+        self.last_ts[usr_id] = ts[-1]
+
+        # Windows never span a gap inside the chunk either
+        splits = np.flatnonzero(np.diff(ts) > self.max_step) + 1
+        for i, (lo, hi) in enumerate(zip(np.r_[0, splits],
+                                         np.r_[splits, ts.shape[0]])):
+            if i:
+                out.extend(self.restart(usr_id))
+            win_ts, batch = self.model_inputs(
+                usr_id, ts[lo:hi], offset[lo:hi],
+                {name: x[lo:hi] for name, x in sensor_data.items()})
+            out.extend(self.decide(usr_id, start, win_ts, batch))
+        return out
+
+    def restart(self, usr_id: str) -> list:
+        '''
+        Drops the partial window of a user after a gap or a restart of the
+        stream, and returns the at desk session it ends, if any.
+        '''
+        self.extractors[usr_id].reset()
+        if not self.smooth:
+            return list()
+        return [{'user': usr_id, 'start': start_t, 'end': end_t}
+                for start_t, end_t in self.smoothers[usr_id].flush()]
+
+    def model_inputs(self, usr_id, ts, offset, sensor_data) -> tuple:
+        '''
+        Returns the start timestamps and the model inputs of the windows
+        closed by a gap free chunk.
+        '''
+        extractor = self.extractors[usr_id]
+        if self.model_input == 'raw':
+            ts_wins, sensor_wins = extractor.push_windows(ts, offset,
+                                                          sensor_data)
+            # Offset windows are taken from ts, same as day_raw_inputs().
+            return (ts_wins[:, 0],
+                    inference.raw_window_inputs(ts_wins, ts_wins,
+                                                sensor_wins))
+        return extractor.push(ts, offset, sensor_data)
+
+    def decide(self, usr_id, start, win_ts, batch) -> list:
+        '''
+        Scores the windows and returns the decisions followed by the at desk
+        sessions they close.
+        '''
+        if not batch.shape[0]:
+            return list()
+        batch = batch.astype(np.float32)
+        if self.normalize:
+            batch = inference.l2_normalize(batch)
+        probs = inference.numpy_predict(self.layers, batch)[:, 1]
+
+        latency_ms = (time.time() - start) * 1000.0
+        decisions = list()
+        sessions = list()
+        for ts, prob in zip(win_ts.tolist(), probs.tolist()):
+            self.latencies.append(latency_ms)
+            decision = {'user': usr_id,
+                        'ts': ts,
+                        'prob': prob,
+                        'at_desk': prob >= self.threshold,
+                        'latency_ms': latency_ms}
+            if self.smooth:
+                smoother = self.smoothers[usr_id]
+                sessions.extend({'user': usr_id, 'start': start_t,
+                                 'end': end_t}
+                                for start_t, end_t in smoother.update(ts, prob))
+                decision['session'] = smoother.at_desk
+            decisions.append(decision)
+        return decisions + sessions
+
+    def latency_stats(self) -> dict:
+        '''
+        Returns the p50 and p99 decision latency in ms of recent windows.
+        '''
+        if not self.latencies:
+            return {'decisions': 0, 'p50_ms': None, 'p99_ms': None,
+                    'users': len(self.extractors)}
+        latencies = np.array(self.latencies)
+        return {'decisions': len(latencies),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'users': len(self.extractors)}
+
+
+def handle_line(detector: Detector, line: bytes) -> list:
+    try:
+        return detector.handle(json.loads(line))
+    except (ValueError, KeyError, TypeError) as e:
+        return [{'error': '%s: %s' % (type(e).__name__, e)}]
+
+
+def encode(msgs: list) -> bytes:
+    return b''.join(json.dumps(msg).encode('utf-8') + b'\n' for msg in msgs)
+
+
+async def serve_connection(detector: Detector, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            out = encode(handle_line(detector, line))
+            if out:
+                writer.write(out)
+                await writer.drain()
+    except ValueError as e:
+        # Line longer than LINE_LIMIT
+        writer.write(encode([{'error': str(e)}]))
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_stdin(detector: Detector):
+    # Blocking reads run in the default executor so that stdin may be a
+    # pipe, a terminal or a regular file.
+    loop = asyncio.get_event_loop()
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.buffer.readline)
+        if not line:
+            break
+        if not line.strip():
+            continue
+        out = encode(handle_line(detector, line))
+        if out:
+            sys.stdout.write(out.decode('utf-8'))
+            sys.stdout.flush()
+
+
+async def report_stats(detector: Detector, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps(detector.latency_stats()), file=sys.stderr)
+
+
+async def run(detector: Detector, args):
+    if args.stats_interval > 0:
+        asyncio.ensure_future(report_stats(detector, args.stats_interval))
+    if args.stdin:
+        await serve_stdin(detector)
+        return
+    server = await asyncio.start_server(
+        lambda r, w: serve_connection(detector, r, w), args.host, args.port,
+        limit=LINE_LIMIT)
+    print('Listening on %s:%d' % (args.host, args.port), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def load_layers(model_path: str) -> list:
+    '''
+    Loads an exported .npz model, exporting a Keras HDF5 model first.
+    '''
+    if model_path.endswith('.npz'):
+        return inference.load_numpy_model(model_path)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        npz_path = os.path.join(tmp_dir, 'model.npz')
+        inference.export_weights(model_path, npz_path)
+        return inference.load_numpy_model(npz_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Online at desk detector over live sensor samples.')
+    parser.add_argument('--model', default=inference.MODEL_PATH,
+                        help='Keras HDF5 model or exported .npz file')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--stdin', action='store_true',
+                        help='read samples from stdin and write decisions '
+                             'to stdout instead of serving a socket')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='at desk probability threshold')
+    parser.add_argument('--smooth', action='store_true',
+                        help='also emit at desk sessions from a hysteresis '
+                             'filter over the window probabilities')
+    parser.add_argument('--no-normalize', action='store_true',
+                        help='do not L2 normalize the rows of a feature '
+                             'model, raw windows are never normalized')
+    parser.add_argument('--stats-interval', type=float, default=60.0,
+                        help='seconds between latency reports on stderr, '
+                             '0 disables them')
+    args = parser.parse_args()
+
+    layers = load_layers(args.model)
+    try:
+        detector = Detector(layers, args.threshold, not args.no_normalize,
+                            args.smooth)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print('Scoring %s inputs of %ds windows'
+          % (detector.model_input, detector.t_win), file=sys.stderr)
+    asyncio.run(run(detector, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 # Standard library imports.
 from datetime import timedelta, datetime
+import argparse
 import pickle
 import json
 
@@ -8,7 +9,10 @@ import numpy as np
 import pandas as pd
 
 # Local application/library specific imports.
+from cache import content_key
+import feature_store
 import features
+import sensors
 import utils
 
 
@@ -54,157 +58,256 @@ def feature_vector(win, freq_feat=True):
 def window_labels(labels, sample_freq, t_win, overlap):
     win_len = int(sample_freq * t_win)
     overlap_len = int(sample_freq * overlap * t_win)
-    label_wins = utils.generate_wins(labels, win_len, overlap_len)
+    label_wins = utils.generate_wins(labels, win_len, overlap_len, view=True)
     return np.array(label_wins)
 
 
 def time_features(ts, offset, sample_freq, t_win, overlap):
     win_len = int(sample_freq * t_win)
     overlap_len = int(sample_freq * overlap * t_win)
-    ts_wins = utils.generate_wins(ts, win_len, overlap_len)
-    offset_wins = utils.generate_wins(ts, win_len, overlap_len)
-    ts_features = list()
-    for ts_win, offset_win in zip(ts_wins, offset_wins):
-        ts_features.append([features.is_weekday(ts_win[0], offset_win[0])])
-    return np.array(ts_features)
+    ts_wins = utils.generate_wins(ts, win_len, overlap_len, view=True)
+    offset_wins = utils.generate_wins(ts, win_len, overlap_len, view=True)
+    ts_features = features.batch_is_weekday(ts_wins[:, 0], offset_wins[:, 0])
+    return ts_features.reshape((-1, 1))
 
 
-def accel_features(accel, sample_freq, t_win, overlap):
-    accel_x = accel[:, 0]
-    accel_y = accel[:, 1]
-    accel_z = accel[:, 2]
-
+def sensor_features(name, data, sample_freq, t_win, overlap):
+    '''
+    Returns the feature matrix of a sensor in sensors.SENSORS from its
+    n_samples x n_fields (or n_samples) resampled data.
+    '''
     win_len = int(sample_freq * t_win)
     overlap_len = int(sample_freq * overlap * t_win)
-    accel_x_wins = utils.generate_wins(accel_x, win_len, overlap_len)
-    accel_y_wins = utils.generate_wins(accel_y, win_len, overlap_len)
-    accel_z_wins = utils.generate_wins(accel_z, win_len, overlap_len)
-    accel_features = list() 
-    for x_win, y_win, z_win in zip(accel_x_wins, accel_y_wins, accel_z_wins):
-        feature_vec = feature_vector(x_win) + feature_vector(y_win) + feature_vector(z_win)
-        feature_vec.append(features.signal_vec_mag(x_win, y_win, z_win))
-        feature_vec.append(features.signal_mag_area(x_win, y_win, z_win))
-
-        accel_features.append(feature_vec)
-    return np.array(accel_features)
-
+    wins = utils.generate_wins(data.reshape((data.shape[0], -1)), win_len,
+                               overlap_len, view=True)
+    return sensors.window_features(name, wins)
 
-def gyro_features(gyro, sample_freq, t_win, overlap):
-    gyro_x = gyro[:, 0]
-    gyro_y = gyro[:, 1]
-    gyro_z = gyro[:, 2]
 
-    win_len = int(sample_freq * t_win)
-    overlap_len = int(sample_freq * overlap * t_win)
-    gyro_x_wins = utils.generate_wins(gyro_x, win_len, overlap_len)
-    gyro_y_wins = utils.generate_wins(gyro_y, win_len, overlap_len)
-    gyro_z_wins = utils.generate_wins(gyro_z, win_len, overlap_len)
-    gyro_features = list() 
-    for x_win, y_win, z_win in zip(gyro_x_wins, gyro_y_wins, gyro_z_wins):
-        feature_vec = feature_vector(x_win) + feature_vector(y_win) + feature_vector(z_win)
-        feature_vec.append(features.signal_vec_mag(x_win, y_win, z_win))
-        feature_vec.append(features.signal_mag_area(x_win, y_win, z_win))
+def accel_features(accel, sample_freq, t_win, overlap):
+    return sensor_features('accel', accel, sample_freq, t_win, overlap)
 
-        gyro_features.append(feature_vec)
-    return np.array(gyro_features)
 
+def gyro_features(gyro, sample_freq, t_win, overlap):
+    return sensor_features('gyro', gyro, sample_freq, t_win, overlap)
 
 
 def act_type_features(act_type, sample_freq, t_win, overlap):
-    win_len = int(sample_freq * t_win)
-    overlap_len = int(sample_freq * overlap * t_win)
-    act_type_wins = utils.generate_wins(act_type[:, 0], win_len, overlap_len)
-    act_features = list()
-    for win in act_type_wins:
-        act_features.append(features.act_type_one_hot(win))
-    return np.array(act_features)
+    return sensor_features('act_type', act_type, sample_freq, t_win, overlap)
 
 
 def step_cnt_features(step_cnt, sample_freq, t_win, overlap):
-
-    win_len = int(sample_freq * t_win)
-    overlap_len = int(sample_freq * overlap * t_win)
-    step_cnt_wins = utils.generate_wins(step_cnt[:, 0], win_len, overlap_len)
-    step_cnt_features = list() 
-    for win in step_cnt_wins:
-        feature_vec = feature_vector(win, False)
-        step_cnt_features.append(feature_vec)
-    return np.array(step_cnt_features)
-
-
-with open(CONFIG_PATH+'users.json', 'r') as f:
-    USR_IDS = json.load(f)
-
-# Load all users' work days
-with open(DATA_PATH+'usr_work_days.pkl', 'rb') as f:
-    USR_WORK_DAYS = pickle.load(f)
-    
-# Load all users' groundtruths
-with open(DATA_PATH+'at_desk_groundtruth.pkl', 'rb') as f:
-    AT_DESK_TIMES = pickle.load(f)
-
-
-data_path = '/home/mperf/sandeep/Codes/data/03996723-2411-4167-b14b-eb11dfc33124/'
-usr_id = '03996723-2411-4167-b14b-eb11dfc33124'
-
-def data_check(mat):
-    if np.isnan(mat).any():
-        print('The matrix has nan value(s)')
-        print(np.where(np.isnan(mat)))
-    if np.isinf(mat).any():
-        print('The matrix has inf value(s)')
-        print(np.where(np.isinf(mat)))
-
-usr_path = DATA_PATH+usr_id+'/'
-
-feat_mats = list()
-label_mats = list()
-for day in USR_WORK_DAYS[usr_id]:
-    print('Creating features on '+ day)
+    return sensor_features('step_cnt', step_cnt, sample_freq, t_win, overlap)
+
+
+def window_features(ts_wins, offset_wins, sensor_wins):
+    '''
+    Returns the feature matrix of already windowed data. sensor_wins maps
+    every sensor of sensors.feature_sensors() to its n_windows x win_len x
+    n_fields windows. The columns are the time features followed by the
+    sensor features, in the same order as the per day feature matrix.
+    '''
+    time_feat = features.batch_is_weekday(ts_wins[:, 0], offset_wins[:, 0])
+    return np.hstack([time_feat.reshape((-1, 1))]
+                     + [sensors.window_features(name, sensor_wins[name])
+                        for name in sensors.feature_sensors()])
+
+
+def feature_groups():
+    '''
+    Returns the column names of every feature group, in the column order of
+    the per day feature matrix.
+    '''
+    groups = dict()
+    groups['time'] = ['is_weekday']
+    for name in sensors.feature_sensors():
+        groups[name] = sensors.feature_names(name)
+    return groups
+
+
+def split_groups(feat_mat, groups):
+    '''
+    Splits a per day feature matrix into a dict of matrices, one per group.
+    '''
+    mats = dict()
+    col = 0
+    for group, names in groups.items():
+        mats[group] = feat_mat[:, col:col + len(names)]
+        col += len(names)
+    return mats
+
+
+def feature_clip_cols():
+    '''
+    Returns a boolean mask of the feature matrix columns clipped by the
+    outlier policy: the time features and the features of every sensor whose
+    feature set is clipped.
+    '''
+    clip = [True] * len(feature_groups()['time'])
+    for name in sensors.feature_sensors():
+        clip.extend([sensors.feature_set(name).clip]
+                    * len(sensors.feature_names(name)))
+    return np.array(clip)
+
+
+def feature_outlier_policy(feat_mat, outlier_mode='clip'):
+    '''
+    Applies features.outlier_policy() to a feature matrix from
+    window_features(). Only the feature_clip_cols() columns are clipped.
+    '''
+    return features.outlier_policy(feat_mat, outlier_mode,
+                                   clip_cols=feature_clip_cols())
+
+
+def group_features(group, data, freq=utils.INTERP_FREQ, t_win=WIN_SIZE,
+                   overlap=OVERLAP):
+    '''
+    Computes one group of day_features() from a loaded data<day>.npz: 'time',
+    a sensor of sensors.feature_sensors() or 'labels'.
+    '''
+    if group == 'time':
+        return time_features(data['ts'], data['offset'], freq, t_win, overlap)
+    if group == 'labels':
+        return window_labels(data['labels'], freq, t_win, overlap)
+    return sensor_features(group, data[group], freq, t_win, overlap)
+
+
+def day_features(usr_id, day, outlier_mode='clip', cache=None):
+    '''
+    Computes the feature matrix and the label windows of one user day from
+    data<day>.npz. NaN feature values are handled by feature_outlier_policy()
+    with outlier_mode. With a FileCache, every feature group is looked up by
+    the content of data<day>.npz and the window parameters, and only the
+    missing groups are computed.
+    Returns (feat_mat, label_wins, NaN count per feature).
+    '''
+    usr_path = DATA_PATH+usr_id+'/'
+    print('Creating features on '+usr_id+' '+day)
     data_fn = usr_path+'data'+day+'.npz'
     data = np.load(data_fn)
-    ts = data['ts']
-    offset = data['offset']
-    accel = data['accel']
-    gyro = data['gyro']
-    step_cnt = data['step_cnt']
-    act_type = data['act_type']
-    lbl = data['labels']
-    print('Computing time features...')
-    time_feat = time_features(ts, offset, utils.INTERP_FREQ, WIN_SIZE, OVERLAP)
-    data_check(time_feat)
-
-    print('Computing accelerometer features...')
-    accel_feat = accel_features(accel, utils.INTERP_FREQ, WIN_SIZE, OVERLAP)
-    data_check(accel_feat)
-    
-    print('Computing gyroscope features...')
-    gyro_feat = gyro_features(gyro, utils.INTERP_FREQ, WIN_SIZE, OVERLAP)
-    data_check(gyro_feat)
-    
-    print('Computing step count features...')
-    step_cnt_feat = step_cnt_features(step_cnt, utils.INTERP_FREQ, WIN_SIZE, OVERLAP)
-    data_check(step_cnt_feat)
-
-    print('Computing activities features...')
-    act_type_feat = act_type_features(act_type, utils.INTERP_FREQ, WIN_SIZE, OVERLAP)
-    data_check(act_type_feat)
-
-    feat_mat = np.hstack((time_feat, accel_feat, gyro_feat, step_cnt_feat, act_type_feat))
-    feat_mats.append(feat_mat)
-
-    print('Creating labels on '+day)
-    label_wins = window_labels(lbl, utils.INTERP_FREQ, WIN_SIZE, OVERLAP)
-    label_mats.append(label_wins)
-
-feat_mats = np.vstack(feat_mats)
-fn = usr_path + 'features'
-print('Saving '+fn)
-np.save(fn, feat_mats)
-
-label_mats = np.vstack(label_mats)
-fn = usr_path + 'labels'
-print('Saving '+fn)
-np.save(fn, label_mats)
-
 
+    groups = ['time'] + sensors.feature_sensors() + ['labels']
+
+    if cache is not None:
+        input_key = content_key([data_fn], {})
+    mats = dict()
+    for group in groups:
+        if cache is None:
+            mats[group] = group_features(group, data)
+            continue
+        key = content_key([], {'input': input_key,
+                               'group': group,
+                               'interp_freq': utils.INTERP_FREQ,
+                               'win_size': WIN_SIZE,
+                               'overlap': OVERLAP,
+                               'version': features.FEATURE_SET_VERSION})
+        mat = cache.get_array(key)
+        if mat is None:
+            mat = group_features(group, data)
+            cache.put_array(key, mat)
+        mats[group] = mat
+
+    feat_mat = np.hstack([mats[group] for group in feature_groups()])
+    label_wins = mats['labels']
+
+    feat_mat, keep, nan_counts = feature_outlier_policy(feat_mat, outlier_mode)
+    return feat_mat, label_wins[keep], nan_counts
+
+
+def save_user_features(usr_id, feat_mats, label_mats):
+    usr_path = DATA_PATH+usr_id+'/'
+    fn = usr_path + 'features'
+    print('Saving '+fn)
+    np.save(fn, np.vstack(feat_mats))
+
+    fn = usr_path + 'labels'
+    print('Saving '+fn)
+    np.save(fn, np.vstack(label_mats))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Create feature and label matrices for all users.')
+    parser.add_argument('--users', nargs='+',
+                        help='user IDs, defaults to all users in users.json')
+    parser.add_argument('--cohort', action='store_true',
+                        help='also save the features and labels of all '
+                             'users in one matrix')
+    parser.add_argument('--outlier-mode', default='clip',
+                        choices=features.OUTLIER_MODES,
+                        help='how NaN feature values are handled')
+    parser.add_argument('--store',
+                        help='also write every user day to the feature '
+                             'store at this path')
+    utils.add_driver_arguments(
+        parser, 'reuse features of unchanged days from this cache directory')
+    args = parser.parse_args()
+    cache = utils.open_cache(args)
+
+    with open(CONFIG_PATH+'users.json', 'r') as f:
+        USR_IDS = json.load(f)
+
+    # Load all users' work days
+    with open(DATA_PATH+'usr_work_days.pkl', 'rb') as f:
+        USR_WORK_DAYS = pickle.load(f)
+
+    usr_ids = list()
+    for usr_id in (args.users or USR_IDS):
+        if usr_id in USR_WORK_DAYS:
+            usr_ids.append(usr_id)
+        else:
+            print(usr_id + ' does not have work days')
+
+    tasks = [(usr_id, day, (args.outlier_mode,))
+             for usr_id in usr_ids
+             for day in USR_WORK_DAYS[usr_id]]
+    results = utils.run_day_tasks(day_features, tasks, args.workers, cache)
+    nan_counts = sum((result[2] for result in results.values()), 0)
+
+    if args.store:
+        groups = feature_groups()
+        win_len = int(utils.INTERP_FREQ * WIN_SIZE)
+        store_groups = dict(groups)
+        store_groups['labels'] = ['label_%d' % i for i in range(win_len)]
+        feature_store.write_schema(args.store, store_groups)
+
+    cohort_feats = list()
+    cohort_labels = list()
+    cohort_usrs = list()
+    for usr_id in usr_ids:
+        # Keep the days in chronological order
+        days = [day for day in USR_WORK_DAYS[usr_id]
+                if (usr_id, day) in results]
+        if not days:
+            print(usr_id + ' has no features')
+            continue
+        feat_mats = [results[(usr_id, day)][0] for day in days]
+        label_mats = [results[(usr_id, day)][1] for day in days]
+        save_user_features(usr_id, feat_mats, label_mats)
+        if args.store:
+            for day, feat_mat, label_mat in zip(days, feat_mats, label_mats):
+                mats = split_groups(feat_mat, groups)
+                mats['labels'] = label_mat
+                feature_store.write_day(args.store, usr_id, day, mats)
+        if args.cohort:
+            cohort_feats.extend(feat_mats)
+            cohort_labels.extend(label_mats)
+            cohort_usrs.extend([usr_id] * sum(len(m) for m in feat_mats))
+
+    if args.cohort and cohort_feats:
+        fn = DATA_PATH + 'cohort_features'
+        print('Saving '+fn)
+        np.save(fn, np.vstack(cohort_feats))
+        fn = DATA_PATH + 'cohort_labels'
+        print('Saving '+fn)
+        np.save(fn, np.vstack(cohort_labels))
+        # User ID of every row of the cohort matrices
+        fn = DATA_PATH + 'cohort_users'
+        print('Saving '+fn)
+        np.save(fn, np.array(cohort_usrs))
+
+    for col in np.nonzero(nan_counts)[0]:
+        print('Feature column %d had %d nan value(s)' % (col, nan_counts[col]))
+
+
+if __name__ == '__main__':
+    main()
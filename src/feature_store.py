@@ -0,0 +1,122 @@
+'''
+This module provides a columnar on-disk store for feature matrices.
+
+Layout of a store:
+    <root>/schema.json                  column names of every feature group
+    <root>/<usr_id>/<day>/<group>.npy   one matrix per user day and group
+
+Every group file has one row per window. Days are written independently,
+so new days are appended without rewriting old ones, and group files are
+read back as read-only memory maps.
+'''
+import json
+import os
+import shutil
+
+import numpy as np
+
+SCHEMA_FN = 'schema.json'
+
+
+def write_schema(root: str, groups: dict):
+    '''
+    Saves the column names of every group, e.g. {'accel': [...], ...}.
+    An existing store must have the same schema.
+    '''
+    schema = {'groups': groups}
+    schema_fn = os.path.join(root, SCHEMA_FN)
+    if os.path.exists(schema_fn):
+        if load_schema(root) != schema:
+            raise ValueError('Feature store ' + root
+                             + ' has a different schema.')
+        return
+    os.makedirs(root, exist_ok=True)
+    with open(schema_fn, 'w') as f:
+        json.dump(schema, f, indent=2)
+
+
+def load_schema(root: str) -> dict:
+    with open(os.path.join(root, SCHEMA_FN), 'r') as f:
+        return json.load(f)
+
+
+def write_day(root: str, usr_id: str, day: str, mats: dict):
+    '''
+    Saves the matrices of one user day, one per group in mats. The day is
+    written to a temporary directory first, so readers never see a
+    partially written day.
+    '''
+    groups = load_schema(root)['groups']
+    n_rows = set()
+    for group, mat in mats.items():
+        if group not in groups:
+            raise ValueError('Unknown feature group ' + group)
+        if mat.shape[1] != len(groups[group]):
+            raise ValueError('Feature group %s has %d columns, expected %d'
+                             % (group, mat.shape[1], len(groups[group])))
+        n_rows.add(mat.shape[0])
+    if len(n_rows) > 1:
+        raise ValueError('Feature groups have different number of rows.')
+
+    usr_path = os.path.join(root, usr_id)
+    day_path = os.path.join(usr_path, day)
+    tmp_path = os.path.join(usr_path, '.' + day + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for group, mat in mats.items():
+        np.save(os.path.join(tmp_path, group + '.npy'),
+                np.asarray(mat, dtype=np.float64))
+    shutil.rmtree(day_path, ignore_errors=True)
+    os.rename(tmp_path, day_path)
+
+
+def users(root: str) -> list:
+    return sorted(name for name in os.listdir(root)
+                  if os.path.isdir(os.path.join(root, name)))
+
+
+def days(root: str, usr_id: str) -> list:
+    usr_path = os.path.join(root, usr_id)
+    if not os.path.isdir(usr_path):
+        return list()
+    return sorted(name for name in os.listdir(usr_path)
+                  if not name.startswith('.'))
+
+
+def load_day(root: str, usr_id: str, day: str, groups=None) -> dict:
+    '''
+    Returns the memory mapped matrices of one user day, keyed by group.
+    '''
+    if groups is None:
+        groups = list(load_schema(root)['groups'])
+    day_path = os.path.join(root, usr_id, day)
+    return {group: np.load(os.path.join(day_path, group + '.npy'),
+                           mmap_mode='r')
+            for group in groups}
+
+
+def column_names(root: str, groups=None) -> list:
+    '''
+    Returns the column names of the given groups in the order they are
+    concatenated by iter_days().
+    '''
+    schema_groups = load_schema(root)['groups']
+    if groups is None:
+        groups = list(schema_groups)
+    names = list()
+    for group in groups:
+        names.extend(schema_groups[group])
+    return names
+
+
+def iter_days(root: str, usr_id: str, groups=None):
+    '''
+    Yields (day, matrix) for every day of a user, where matrix has the
+    columns of the given groups side by side. Only one day is loaded at a
+    time.
+    '''
+    if groups is None:
+        groups = list(load_schema(root)['groups'])
+    for day in days(root, usr_id):
+        mats = load_day(root, usr_id, day, groups)
+        yield day, np.hstack([mats[group] for group in groups])
@@ -9,11 +9,15 @@ import utils
 MAX_VAL = 1e6
 MIN_VAL = 1e-6
 
+# Bump when a feature computation changes, it invalidates cached features
+FEATURE_SET_VERSION = 1
+
+# NaN handling modes of outlier_policy()
+OUTLIER_MODES = ('clip', 'impute', 'drop', 'raise')
+
 def outlier_check(val):
     if np.isnan(val):
-        print('val is nan')
-        import pdb
-        pdb.set_trace()
+        # NaN are handled by outlier_policy() on the feature matrix
         return np.nan
     elif val > MAX_VAL:
         return MAX_VAL
@@ -276,20 +280,21 @@ def mcr(data):
         print('mcr:', 'input is not numpy array')
         return np.nan
 
-    mean = np.mean(data)
-    crossed = 0
-    below = data[0] <= mean
-    for i in data:
-        if i <= mean and not below:
-            below = True
-            crossed += 1
-        elif i > mean and below:
-            below = False
-            crossed += 1
+    crossed = batch_mcr(data[np.newaxis])[0]
             
     return outlier_check(crossed)
 
 
+def batch_mcr(wins):
+    '''
+    Returns the number of mean crossings of every row of wins
+    (n_windows x win_len). Samples equal to the mean count as below it.
+    '''
+    below = wins <= np.mean(wins, axis=1)[:, np.newaxis]
+    crossed = np.count_nonzero(below[:, 1:] != below[:, :-1], axis=1)
+    return crossed.astype(np.float64)
+
+
 def abs_area(data):
     '''
     Returns the absolute area, or the absolute sum of the data.
@@ -403,8 +408,7 @@ def dc_component(data, sampling_rate):
         print('dc_component:', 'input is not numpy array')
         return np.nan
     
-    X = fftpack.fft(data)
-    val = np.abs(X[0])
+    val = spectral_features(data[np.newaxis])[0][0]
     return outlier_check(val)
 
 
@@ -449,15 +453,7 @@ def energy(data):
         print('energy:', 'input is not numpy array')
         return np.nan
 
-    fft_data = fftpack.fft(data)
-    fft_data = np.absolute(fft_data)
-    
-    half = int((len(fft_data) + 1) / 2)
-    total = 0
-    for i in range(half):
-        total += fft_data[i] ** 2
-    
-    val = total
+    val = spectral_features(data[np.newaxis])[1][0]
     
     return outlier_check(val)
 
@@ -470,18 +466,7 @@ def entropy(data):
         print('entropy:', 'input is not numpy array')
         return np.nan
 
-    X = np.abs(fftpack.fft(data))
-    
-    psd = X**2 / X.size
-
-    div = np.sum(psd)
-    if div == 0.0:
-        div = MIN_VAL
-    psd = psd / div # Normalize psd
-    psd[np.where(psd==0.0)] = MIN_VAL
-    ln_psd = np.log(psd)
-
-    val = np.sum(psd * ln_psd) * - 1
+    val = spectral_features(data[np.newaxis])[2][0]
 
     return outlier_check(val)
 
@@ -495,14 +480,300 @@ def dom_freq_ratio(data):
         print('dom_freq_ratio:', 'input is not numpy array')
         return np.nan
 
-    fft_data = fftpack.fft(data)
-    fft_data = np.abs(fft_data)
-    div = np.sum(fft_data)
-    if div == 0.0:
-        div = MIN_VAL
-    
-    val = np.max(fft_data) / div
+    val = spectral_features(data[np.newaxis])[3][0]
     
     return outlier_check(val)
 
+
+def spectral_features(wins):
+    '''
+    Computes one real FFT per row of wins (n_windows x win_len) and returns
+    the arrays (dc_component, energy, entropy, dom_freq_ratio).
+    The spectrum of a real signal is symmetric, so sums over the full FFT
+    are taken over the rfft bins with the mirrored bins counted twice.
+    '''
+    n = wins.shape[1]
+    X = np.abs(np.fft.rfft(wins, axis=1))
+    weights = np.ones(X.shape[1])
+    weights[1:(n + 1) // 2] = 2
+
+    dc_val = X[:, 0]
+
+    # Energy of the first half of the full spectrum
+    half = int((n + 1) / 2)
+    energy_val = np.sum(X[:, :half]**2, axis=1)
+
+    psd = X**2 / n
+    div = np.dot(psd, weights)
+    div[div == 0.0] = MIN_VAL
+    psd = psd / div[:, np.newaxis] # Normalize psd
+    psd[psd == 0.0] = MIN_VAL
+    entropy_val = np.dot(psd * np.log(psd), weights) * -1
+
+    div = np.dot(X, weights)
+    div[div == 0.0] = MIN_VAL
+    dom_freq_ratio_val = np.max(X, axis=1) / div
+
+    return dc_val, energy_val, entropy_val, dom_freq_ratio_val
+
 # Frequency domain feature ends
+
+
+# Batch features start
+
+# Column names of feature_vector(), in output order.
+TIME_FEATURE_NAMES = ['mean', 'mad', 'mini', 'maxi', 'median', 'var', 'std',
+                      'ran', 'abs_mean', 'coeff_var', 'skewness', 'kurtosis',
+                      'quartile1', 'quartile3', 'iqr', 'mcr', 'rms', 'slope',
+                      'integral']
+FREQ_FEATURE_NAMES = ['dc_component', 'energy', 'entropy', 'dom_freq_ratio']
+
+
+def batch_outlier_check(vals):
+    '''
+    Vectorized outlier_check() over an array of feature values.
+    '''
+    return np.clip(np.asarray(vals, dtype=np.float64), MIN_VAL, MAX_VAL)
+
+
+def outlier_policy(feat_mat, mode='clip', impute_val=MIN_VAL, clip_cols=None):
+    '''
+    Clips a feature matrix (n_windows x n_features) to [MIN_VAL, MAX_VAL] and
+    handles NaN values according to mode:
+        clip: keep NaN values
+        impute: replace NaN values with impute_val
+        drop: remove windows which have any NaN value
+        raise: raise ValueError if there is any NaN value
+    clip_cols selects the clipped columns, defaults to all columns.
+    Return
+        (output matrix, boolean mask of kept windows, NaN count per feature)
+    '''
+    if mode not in OUTLIER_MODES:
+        raise ValueError('Unknown outlier mode ' + str(mode))
+    feat_mat = np.array(feat_mat, dtype=np.float64)
+    if clip_cols is None:
+        clip_cols = slice(None)
+    feat_mat[:, clip_cols] = batch_outlier_check(feat_mat[:, clip_cols])
+    nan_mask = np.isnan(feat_mat)
+    nan_counts = np.sum(nan_mask, axis=0)
+    keep = np.ones(feat_mat.shape[0], dtype=bool)
+    if not nan_counts.any():
+        return feat_mat, keep, nan_counts
+
+    if mode == 'raise':
+        raise ValueError('Feature matrix has nan value(s) in column(s) '
+                         + str(np.nonzero(nan_counts)[0].tolist()))
+    elif mode == 'impute':
+        feat_mat[nan_mask] = impute_val
+    elif mode == 'drop':
+        keep = ~nan_mask.any(axis=1)
+        feat_mat = feat_mat[keep]
+    return feat_mat, keep, nan_counts
+
+
+def sorted_percentile(sorted_wins, perc):
+    '''
+    Returns the given percentile of every row of an already sorted window
+    matrix, with the linear interpolation of np.percentile.
+    '''
+    pos = perc / 100.0 * (sorted_wins.shape[1] - 1)
+    below = int(np.floor(pos))
+    above = min(below + 1, sorted_wins.shape[1] - 1)
+    t = pos - below
+    a = sorted_wins[:, below]
+    b = sorted_wins[:, above]
+    if t >= 0.5:
+        return b - (b - a) * (1 - t)
+    return a + (b - a) * t
+
+
+def order_stats(wins):
+    '''
+    Sorts every row of wins (n_windows x win_len) once and returns a dict of
+    arrays with the median, quartile1, quartile3, iqr, mad, mini, maxi and
+    ran of each window.
+    '''
+    n = wins.shape[1]
+    sorted_wins = np.sort(wins, axis=1)
+    mid = n // 2
+    if n % 2:
+        median_val = sorted_wins[:, mid]
+    else:
+        median_val = (sorted_wins[:, mid - 1] + sorted_wins[:, mid]) / 2
+
+    # Median of the absolute deviations only needs its middle elements
+    dev = np.abs(wins - median_val[:, np.newaxis])
+    if n % 2:
+        mad_val = np.partition(dev, mid, axis=1)[:, mid]
+    else:
+        dev = np.partition(dev, [mid - 1, mid], axis=1)
+        mad_val = (dev[:, mid - 1] + dev[:, mid]) / 2
+
+    q1_val = sorted_percentile(sorted_wins, 25)
+    q3_val = sorted_percentile(sorted_wins, 75)
+    min_val = sorted_wins[:, 0]
+    max_val = sorted_wins[:, n - 1]
+    return {'median': median_val,
+            'quartile1': q1_val,
+            'quartile3': q3_val,
+            'iqr': q3_val - q1_val,
+            'mad': mad_val,
+            'mini': min_val,
+            'maxi': max_val,
+            'ran': max_val - min_val}
+
+
+def moments(wins):
+    '''
+    Computes the raw and central moments up to the 4th order of every row of
+    wins (n_windows x win_len) and returns a dict of arrays with the mean,
+    var, std, skewness, kurtosis, coeff_var, rms and abs_mean of each window.
+    Skewness and kurtosis are the biased estimators of scipy.stats. Windows
+    whose variance is below the float resolution of their mean have 0
+    skewness and -3 kurtosis instead of dividing by a zero variance.
+    '''
+    mean_val = np.mean(wins, axis=1)
+    raw2 = np.mean(wins**2, axis=1)
+    abs_mean_val = np.mean(np.absolute(wins), axis=1)
+
+    # Central moments from the centered data for numerical stability
+    centered = wins - mean_val[:, np.newaxis]
+    centered2 = centered**2
+    m2 = np.mean(centered2, axis=1)
+    m3 = np.mean(centered2 * centered, axis=1)
+    m4 = np.mean(centered2**2, axis=1)
+
+    std_val = np.sqrt(m2)
+    zero = m2 <= (np.finfo(np.float64).eps * mean_val)**2
+    safe_m2 = np.where(zero, 1.0, m2)
+    skew_val = np.where(zero, 0.0, m3 / safe_m2**1.5)
+    kurt_val = np.where(zero, 0.0, m4 / safe_m2**2) - 3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coeff_var_val = std_val / mean_val
+    coeff_var_val[np.isnan(coeff_var_val)] = MAX_VAL
+
+    return {'mean': mean_val,
+            'var': m2,
+            'std': std_val,
+            'skewness': skew_val,
+            'kurtosis': kurt_val,
+            'coeff_var': coeff_var_val,
+            'rms': np.sqrt(raw2),
+            'abs_mean': abs_mean_val}
+
+
+def batch_time_features(wins):
+    '''
+    Returns the time domain features of feature_vector() for every row of
+    wins (n_windows x win_len), one column per feature.
+    '''
+    n = wins.shape[1]
+    moment = moments(wins)
+    order = order_stats(wins)
+    q1_val = batch_outlier_check(order['quartile1'])
+    q3_val = batch_outlier_check(order['quartile3'])
+    mcr_val = batch_mcr(wins)
+    slope_val = (wins[:, n - 1] - wins[:, 0]) / (n - 1)
+    # Trapezoidal rule with dx=1, same as np.trapz(win, dx=1).
+    integral_val = np.sum(wins, axis=1) - (wins[:, 0] + wins[:, n - 1]) / 2
+
+    cols = [moment['mean'], order['mad'], order['mini'], order['maxi'],
+            order['median'], moment['var'], moment['std'], order['ran'],
+            moment['abs_mean'], moment['coeff_var'], moment['skewness'],
+            moment['kurtosis'], q1_val, q3_val, q3_val - q1_val, mcr_val,
+            moment['rms'], slope_val, integral_val]
+    return batch_outlier_check(np.column_stack(cols))
+
+
+def batch_freq_features(wins):
+    '''
+    Returns dc_component, energy, entropy and dom_freq_ratio for every row of
+    wins (n_windows x win_len), one column per feature.
+    '''
+    return batch_outlier_check(np.column_stack(spectral_features(wins)))
+
+
+def batch_feature_vector(wins, freq_feat=True):
+    '''
+    Batch version of feature_vector(). Takes the window matrix
+    (n_windows x win_len) of one axis and returns a feature matrix with the
+    same column order as feature_vector().
+    '''
+    if not isinstance(wins, np.ndarray):
+        print('batch_feature_vector:', 'input is not numpy array')
+        return None
+    wins = np.atleast_2d(wins).astype(np.float64, copy=False)
+
+    time_feat = batch_time_features(wins)
+    if not freq_feat:
+        return time_feat
+    return np.hstack((time_feat, batch_freq_features(wins)))
+
+
+def batch_signal_vec_mag(x_wins, y_wins, z_wins):
+    '''
+    Returns signal_vec_mag() of every window across all three axes.
+    '''
+    val = np.mean(np.sqrt(x_wins**2 + y_wins**2 + z_wins**2), axis=1)
+    return batch_outlier_check(val)
+
+
+def batch_signal_mag_area(x_wins, y_wins, z_wins):
+    '''
+    Returns signal_mag_area() of every window across all three axes.
+    '''
+    val = (batch_outlier_check(np.sum(np.abs(x_wins), axis=1))
+           + batch_outlier_check(np.sum(np.abs(y_wins), axis=1))
+           + batch_outlier_check(np.sum(np.abs(z_wins), axis=1)))
+    return batch_outlier_check(val)
+
+
+def batch_triaxial_features(x_wins, y_wins, z_wins):
+    '''
+    Returns the feature matrix of a three axes sensor: feature_vector() of
+    x, y and z followed by signal_vec_mag and signal_mag_area.
+    '''
+    x_wins = np.atleast_2d(x_wins).astype(np.float64, copy=False)
+    y_wins = np.atleast_2d(y_wins).astype(np.float64, copy=False)
+    z_wins = np.atleast_2d(z_wins).astype(np.float64, copy=False)
+    return np.column_stack((batch_feature_vector(x_wins),
+                            batch_feature_vector(y_wins),
+                            batch_feature_vector(z_wins),
+                            batch_signal_vec_mag(x_wins, y_wins, z_wins),
+                            batch_signal_mag_area(x_wins, y_wins, z_wins)))
+
+
+def batch_is_weekday(timestamps, offsets):
+    '''
+    Returns is_weekday() of every (timestamp, offset) pair.
+    '''
+    local_t = np.asarray(timestamps, dtype=np.float64) + offsets
+    days = np.floor_divide(local_t, 86400)
+    # 1970-01-01 is a Thursday, i.e. isoweekday 4.
+    iso_weekday = (days + 3) % 7 + 1
+    return batch_outlier_check((iso_weekday < 6).astype(np.float64))
+
+
+def batch_local_hour(timestamps, offsets):
+    '''
+    Returns local_hour() of every (timestamp, offset) pair.
+    '''
+    local_t = np.asarray(timestamps, dtype=np.float64) + offsets
+    hour = np.floor_divide(local_t, 3600) % 24
+    return batch_outlier_check(hour)
+
+
+def batch_act_type_one_hot(wins):
+    '''
+    Returns act_type_one_hot() of every window.
+    '''
+    act_types = np.atleast_2d(wins).astype(int)
+    if (act_types > utils.MAX_ACT_TYPE).any() or (act_types < 0).any():
+        print("Act type is output range.")
+    counts = np.stack([np.sum(act_types == i, axis=1)
+                       for i in range(utils.NUM_ACT_TYPE)], axis=1)
+    # argmax picks the smallest type on ties, same as stats.mode
+    most_common_type = np.argmax(counts, axis=1)
+    return np.eye(utils.NUM_ACT_TYPE)[most_common_type]
+
+# Batch features end
@@ -0,0 +1,275 @@
+'''
+This module runs the at desk DNN model over raw sensor windows or a feature
+matrix on the CPU, either with Keras or with a NumPy forward pass over
+exported weights. The input is chosen by the input width of the model.
+'''
+# Standard library imports.
+import argparse
+import json
+import os
+import time
+
+# Related third party imports.
+import numpy as np
+
+MODEL_PATH = '../models/DNN_Model-10Second'
+BATCH_SIZE = 4096
+
+# The shipped model was trained by DNN_baseline_raw_data.ipynb on raw 2s
+# windows, not on the feature matrix of feature_extraction.py.
+RAW_WIN_SIZE = 2 # 2s
+RAW_OVERLAP = 0
+# (sensor, field) of every raw window channel, in column order
+RAW_CHANNELS = [('accel', 0), ('accel', 1), ('accel', 2),
+                ('gyro', 0), ('gyro', 1), ('gyro', 2),
+                ('step_cnt', 0), ('act_type', 0)]
+# Samples of a raw window at utils.INTERP_FREQ
+RAW_WIN_LEN = 40
+# Channel samples followed by is_weekday and local_hour
+RAW_INPUT_DIM = len(RAW_CHANNELS) * RAW_WIN_LEN + 2
+# The time inputs are clipped to features.MIN_VAL and MAX_VAL, same as
+# features.outlier_check()
+MIN_VAL = 1e-6
+MAX_VAL = 1e6
+
+# Only the feature model was trained on L2 normalized rows
+NORMALIZED_INPUTS = ('features',)
+
+
+def feature_input_dim() -> int:
+    '''
+    Returns the width of the feature matrix of feature_extraction.py.
+    Imported here so that raw window scoring only needs NumPy.
+    '''
+    import feature_extraction
+    return sum(len(names) for names
+               in feature_extraction.feature_groups().values())
+
+
+def model_input(n_inputs: int) -> str:
+    '''
+    Returns the input of a model by its input width, 'raw' or 'features',
+    or None if it takes neither.
+    '''
+    if n_inputs == RAW_INPUT_DIM:
+        return 'raw'
+    if n_inputs == feature_input_dim():
+        return 'features'
+    return None
+
+
+def l2_normalize(mat: np.ndarray) -> np.ndarray:
+    '''
+    Scales every row to unit L2 norm, same as
+    sklearn.preprocessing.normalize used when the model was trained.
+    '''
+    norms = np.sqrt(np.einsum('ij,ij->i', mat, mat))
+    norms[norms == 0.0] = 1.0
+    return mat / norms[:, np.newaxis]
+
+
+def load_keras_model(model_path: str):
+    '''
+    Loads the Keras HDF5 model. GPUs are hidden so the model always runs on
+    the CPU.
+    '''
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    from tensorflow import keras
+    return keras.models.load_model(model_path, compile=False)
+
+
+def export_weights(model_path: str, npz_path: str):
+    '''
+    Reads the dense layer weights of a Keras HDF5 model and saves them with
+    their activations to a .npz file for numpy_predict(). Dropout layers
+    are left out since they do nothing at inference time.
+    '''
+    import h5py
+
+    with h5py.File(model_path, 'r') as f:
+        config = f.attrs['model_config']
+        if isinstance(config, bytes):
+            config = config.decode('utf-8')
+        config = json.loads(config)['config']
+        if isinstance(config, dict):
+            config = config['layers']
+
+        arrays = dict()
+        activations = list()
+        for layer in config:
+            if layer['class_name'] == 'Dropout':
+                continue
+            if layer['class_name'] != 'Dense':
+                raise ValueError('Unsupported layer ' + layer['class_name'])
+            name = layer['config']['name']
+            group = f['model_weights'][name]
+            weights = [group[w] for w in group.attrs['weight_names']]
+            i = len(activations)
+            arrays['kernel_%d' % i] = np.asarray(weights[0], dtype=np.float32)
+            arrays['bias_%d' % i] = np.asarray(weights[1], dtype=np.float32)
+            activations.append(layer['config']['activation'])
+
+    np.savez(npz_path, activations=np.array(activations), **arrays)
+
+
+def load_numpy_model(npz_path: str) -> list:
+    '''
+    Returns the (kernel, bias, activation) of every layer of an exported
+    model.
+    '''
+    data = np.load(npz_path)
+    activations = [str(a) for a in data['activations']]
+    return [(data['kernel_%d' % i], data['bias_%d' % i], activation)
+            for i, activation in enumerate(activations)]
+
+
+def numpy_predict(layers: list, batch: np.ndarray) -> np.ndarray:
+    '''
+    Forward pass of the dense layers over a batch (n_windows x n_features).
+    '''
+    x = batch
+    for kernel, bias, activation in layers:
+        x = np.dot(x, kernel) + bias
+        if activation == 'relu':
+            x = np.maximum(x, 0.0)
+        elif activation == 'softmax':
+            x = np.exp(x - np.max(x, axis=1, keepdims=True))
+            x = x / np.sum(x, axis=1, keepdims=True)
+        elif activation == 'sigmoid':
+            x = 1.0 / (1.0 + np.exp(-x))
+        elif activation == 'tanh':
+            x = np.tanh(x)
+        elif activation != 'linear':
+            raise ValueError('Unsupported activation ' + activation)
+    return x
+
+
+def raw_window_inputs(ts_wins, offset_wins, sensor_wins):
+    '''
+    Returns the raw window input of every window: the samples of every
+    RAW_CHANNELS channel, then is_weekday and local_hour of the window start.
+    Takes the same windows as feature_extraction.window_features().
+    '''
+    cols = [sensor_wins[name][:, :, field] for name, field in RAW_CHANNELS]
+    # Same as features.batch_is_weekday() and batch_local_hour()
+    local_t = np.asarray(ts_wins[:, 0], dtype=np.float64) + offset_wins[:, 0]
+    # 1970-01-01 is a Thursday, i.e. isoweekday 4.
+    iso_weekday = (np.floor_divide(local_t, 86400) + 3) % 7 + 1
+    hour = np.floor_divide(local_t, 3600) % 24
+    time_cols = np.column_stack(((iso_weekday < 6).astype(np.float64), hour))
+    cols.append(np.clip(time_cols, MIN_VAL, MAX_VAL))
+    return np.hstack(cols)
+
+
+def day_raw_inputs(data_fn: str, t_win=RAW_WIN_SIZE, overlap=RAW_OVERLAP):
+    '''
+    Returns the raw window input matrix of a preprocessed data<day>.npz.
+    '''
+    import utils
+    data = np.load(data_fn)
+    win_len = int(utils.INTERP_FREQ * t_win)
+    overlap_len = int(utils.INTERP_FREQ * overlap * t_win)
+    ts_wins = utils.generate_wins(data['ts'], win_len, overlap_len, view=True)
+    sensor_wins = dict()
+    for name in set(name for name, _ in RAW_CHANNELS):
+        x = data[name].reshape((data[name].shape[0], -1))
+        sensor_wins[name] = utils.generate_wins(x, win_len, overlap_len,
+                                                view=True)
+    # Offset windows are taken from ts, same as the training notebook.
+    return raw_window_inputs(ts_wins, ts_wins, sensor_wins)
+
+
+def predict_batches(predict, feat_mat, out, batch_size=BATCH_SIZE,
+                    normalize=False):
+    '''
+    Streams feat_mat (n_windows x n_features, e.g. a memory map) through
+    predict in batches and writes the at desk probability of every window
+    into out. Returns the number of windows per second.
+    '''
+    start = time.time()
+    for i in range(0, feat_mat.shape[0], batch_size):
+        batch = np.asarray(feat_mat[i:i + batch_size], dtype=np.float32)
+        if normalize:
+            batch = l2_normalize(batch)
+        # Column 1 is the softmax output of the at desk class
+        out[i:i + batch.shape[0]] = predict(batch)[:, 1]
+    elapsed = time.time() - start
+    if elapsed == 0.0:
+        return float('inf')
+    return feat_mat.shape[0] / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Predict at desk probabilities of every window.')
+    parser.add_argument('input', nargs='?',
+                        help='preprocessed data<day>.npz for a raw window '
+                             'model such as the shipped one, or '
+                             'features.npy for a feature model')
+    parser.add_argument('--model', default=MODEL_PATH,
+                        help='Keras HDF5 model file, or a .npz file from '
+                             '--export to predict without Keras')
+    parser.add_argument('--export',
+                        help='save the weights of --model to this .npz '
+                             'file and exit')
+    parser.add_argument('--output',
+                        help='output .npy file, defaults to '
+                             '<input>_probs.npy')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--no-normalize', action='store_true',
+                        help='do not L2 normalize the rows of a feature '
+                             'model input, raw windows are never normalized')
+    args = parser.parse_args()
+
+    if args.export:
+        export_weights(args.model, args.export)
+        print('Saved '+args.export)
+        return
+    if args.input is None:
+        parser.error('the input file is required')
+
+    output_fn = args.output
+    if output_fn is None:
+        output_fn = os.path.splitext(args.input)[0] + '_probs.npy'
+
+    print('Loading '+args.model)
+    if args.model.endswith('.npz'):
+        layers = load_numpy_model(args.model)
+        predict = lambda batch: numpy_predict(layers, batch)
+        n_inputs = layers[0][0].shape[0]
+    else:
+        model = load_keras_model(args.model)
+        predict = lambda batch: np.asarray(model.predict_on_batch(batch))
+        n_inputs = model.input_shape[-1]
+
+    input_kind = model_input(n_inputs)
+    if input_kind is None:
+        parser.error('the model expects %d inputs, neither raw windows (%d) '
+                     'nor features (%d)'
+                     % (n_inputs, RAW_INPUT_DIM, feature_input_dim()))
+    if input_kind == 'raw':
+        if not args.input.endswith('.npz'):
+            parser.error('the model takes raw windows of a preprocessed '
+                         'data<day>.npz, not ' + args.input)
+        feat_mat = day_raw_inputs(args.input)
+    else:
+        if not args.input.endswith('.npy'):
+            parser.error('the model takes a feature matrix .npy, not '
+                         + args.input)
+        feat_mat = np.load(args.input, mmap_mode='r')
+    if feat_mat.ndim != 2 or feat_mat.shape[1] != n_inputs:
+        parser.error('the model expects %d inputs, %s has shape %s'
+                     % (n_inputs, args.input, feat_mat.shape))
+
+    normalize = input_kind in NORMALIZED_INPUTS and not args.no_normalize
+    out = np.lib.format.open_memmap(output_fn, mode='w+', dtype=np.float32,
+                                    shape=(feat_mat.shape[0],))
+    throughput = predict_batches(predict, feat_mat, out, args.batch_size,
+                                 normalize)
+    out.flush()
+    print('Saved %d predictions to %s, %.0f windows/sec'
+          % (feat_mat.shape[0], output_fn, throughput))
+
+
+if __name__ == '__main__':
+    main()
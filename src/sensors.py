@@ -0,0 +1,157 @@
+'''
+This module declares the phone sensors of the pipeline: the fields and
+bounds of their samples, whether they are resampled onto the INTERP_FREQ
+grid and the features computed over their windows. Validation,
+preprocessing and feature extraction read the sensors from here, so a new
+sensor or feature set is one more SENSORS entry.
+'''
+from collections import OrderedDict, namedtuple
+
+import features
+import utils
+
+# Columns of utils.to_numpy_array(): start time, end time, offset, sample
+TS_COL = 0
+OFFSET_COL = 2
+SAMPLE_COL = 3
+
+# A sample field and its valid range
+Field = namedtuple('Field', ['name', 'min', 'max'])
+
+# name: key of the sensor in file names and arrays
+# stream: CerebralCortex stream label, read by data_preprocess.export_user()
+# fields: Field of every sample value in order
+# resampled: True if preprocessing resamples it onto the INTERP_FREQ grid.
+#     This is a flag, not a per sensor sampling rate: all resampled sensors
+#     share one grid, because windows span all of them and the models were
+#     trained at INTERP_FREQ.
+# feature: key of FEATURE_KERNELS computed over its windows, or None
+Sensor = namedtuple('Sensor', ['name', 'stream', 'fields', 'resampled',
+                               'feature'])
+
+# kernel: kernel(sensor, n_windows x win_len x n_cols windows) returning
+#     an n_windows x n_features matrix
+# names: names(sensor) returning the feature column names
+# n_cols: number of leading sample fields the kernel reads
+# clip: True if the features are clipped by the outlier policy
+FeatureSet = namedtuple('FeatureSet', ['kernel', 'names', 'n_cols', 'clip'])
+
+
+def triaxial_kernel(sensor, wins):
+    return features.batch_triaxial_features(wins[:, :, 0], wins[:, :, 1],
+                                            wins[:, :, 2])
+
+
+def triaxial_names(sensor):
+    axis_names = features.TIME_FEATURE_NAMES + features.FREQ_FEATURE_NAMES
+    return ([sensor.name + '_' + field.name + '_' + name
+             for field in sensor.fields[:3] for name in axis_names]
+            + [sensor.name + '_signal_vec_mag',
+               sensor.name + '_signal_mag_area'])
+
+
+def time_stats_kernel(sensor, wins):
+    return features.batch_feature_vector(wins[:, :, 0], False)
+
+
+def time_stats_names(sensor):
+    return [sensor.name + '_' + name for name in features.TIME_FEATURE_NAMES]
+
+
+def one_hot_kernel(sensor, wins):
+    return features.batch_act_type_one_hot(wins[:, :, 0])
+
+
+def one_hot_names(sensor):
+    field = sensor.fields[0]
+    return [sensor.name + '_%d' % i
+            for i in range(int(field.max - field.min) + 1)]
+
+
+FEATURE_KERNELS = {
+    'triaxial': FeatureSet(triaxial_kernel, triaxial_names, 3, True),
+    'time_stats': FeatureSet(time_stats_kernel, time_stats_names, 1, True),
+    # One hot columns are 0 or 1, clipping would turn 0 into MIN_VAL
+    'one_hot': FeatureSet(one_hot_kernel, one_hot_names, 1, False),
+}
+
+# Sensors with a feature set are in the column order of the feature matrix
+SENSORS = OrderedDict((sensor.name, sensor) for sensor in [
+    Sensor('accel', 'ACCELEROMETER--org.md2k.phonesensor--PHONE',
+           [Field('x', utils.MIN_ACCEL, utils.MAX_ACCEL),
+            Field('y', utils.MIN_ACCEL, utils.MAX_ACCEL),
+            Field('z', utils.MIN_ACCEL, utils.MAX_ACCEL)],
+           True, 'triaxial'),
+    Sensor('gyro', 'GYROSCOPE--org.md2k.phonesensor--PHONE',
+           [Field('x', utils.MIN_GYRO, utils.MAX_GYRO),
+            Field('y', utils.MIN_GYRO, utils.MAX_GYRO),
+            Field('z', utils.MIN_GYRO, utils.MAX_GYRO)],
+           True, 'triaxial'),
+    Sensor('step_cnt', 'STEP_COUNT--org.md2k.phonesensor--PHONE',
+           [Field('cnt', utils.MIN_STEP_CNT, utils.MAX_STEP_CNT)],
+           True, 'time_stats'),
+    Sensor('act_type', 'ACTIVITY_TYPE--org.md2k.phonesensor--PHONE',
+           [Field('type', utils.MIN_ACT_TYPE, utils.MAX_ACT_TYPE),
+            Field('confidence', utils.MIN_CONFIDENCE, utils.MAX_CONFIDENCE)],
+           True, 'one_hot'),
+    Sensor('location', 'LOCATION--org.md2k.phonesensor--PHONE',
+           [Field('lat', utils.MIN_LOC_LAT, utils.MAX_LOC_LAT),
+            Field('lon', utils.MIN_LOC_LON, utils.MAX_LOC_LON),
+            Field('alt', utils.MIN_LOC_ALT, utils.MAX_LOC_ALT),
+            Field('speed', utils.MIN_LOC_SPEED, utils.MAX_LOC_SPEED),
+            Field('bearing', utils.MIN_LOC_BEAR, utils.MAX_LOC_BEAR),
+            Field('accuracy', utils.MIN_LOC_ACCUR, utils.MAX_LOC_ACCUR)],
+           False, None),
+    Sensor('light', 'AMBIENT_LIGHT--org.md2k.phonesensor--PHONE',
+           [Field('intensity', utils.MIN_LIGHT_INTENSITY,
+                  utils.MAX_LIGHT_INTENSITY)],
+           False, None),
+    Sensor('proximity', 'PROXIMITY--org.md2k.phonesensor--PHONE',
+           [Field('proximity', utils.MIN_PROXIMITY, utils.MAX_PROXIMITY)],
+           False, None),
+    Sensor('battery', 'BATTERY--org.md2k.phonesensor--PHONE',
+           [Field('level', utils.MIN_BATT_LEVEL, utils.MAX_BATT_LEVEL),
+            Field('volt', utils.MIN_BATT_VOLT, utils.MAX_BATT_VOLT),
+            Field('temp', utils.MIN_BATT_TEMP, utils.MAX_BATT_TEMP)],
+           False, None),
+    Sensor('beacon', 'BEACON--org.md2k.beacon--BEACON--WORK',
+           [Field('dis', utils.MIN_BLE_DIS, utils.MAX_BLE_DIS),
+            Field('rssi', utils.MIN_BLE_RSSI, utils.MAX_BLE_RSSI),
+            Field('tx', utils.MIN_BLE_TX, utils.MAX_BLE_TX)],
+           False, None),
+])
+
+
+def resampled_sensors():
+    'Returns the names of the sensors resampled by preprocessing, sorted'
+    return sorted(name for name, sensor in SENSORS.items()
+                  if sensor.resampled)
+
+
+def feature_sensors():
+    'Returns the names of the sensors with a feature set, in column order'
+    return [name for name, sensor in SENSORS.items()
+            if sensor.feature is not None]
+
+
+def sample_cols(name):
+    'Returns the slice of the sample fields in a utils.to_numpy_array() array'
+    return slice(SAMPLE_COL, SAMPLE_COL + len(SENSORS[name].fields))
+
+
+def feature_set(name):
+    'Returns the FeatureSet of a sensor'
+    return FEATURE_KERNELS[SENSORS[name].feature]
+
+
+def feature_names(name):
+    'Returns the feature column names of a sensor'
+    return feature_set(name).names(SENSORS[name])
+
+
+def window_features(name, wins):
+    '''
+    Returns the n_windows x n_features matrix of a sensor from its
+    n_windows x win_len x n_cols (or more) windows.
+    '''
+    return feature_set(name).kernel(SENSORS[name], wins)
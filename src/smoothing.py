@@ -0,0 +1,119 @@
+'''
+This module turns the per window at desk probabilities into stable at desk
+sessions with a hysteresis filter. A session starts after enough windows
+above the enter threshold and ends after enough windows below the exit
+threshold, so isolated flips of the model do not split or create sessions.
+'''
+# Standard library imports.
+from datetime import datetime, timezone
+
+# Related third party imports.
+import numpy as np
+
+# Window length in seconds, feature_extraction.WIN_SIZE
+WIN_SIZE = 10
+ENTER_THRESH = 0.6
+EXIT_THRESH = 0.4
+# Number of consecutive windows needed to enter or leave a session
+ENTER_WINS = 2
+EXIT_WINS = 3
+
+
+def to_datetime(t):
+    'Converts a UTC timestamp to a naive datetime, same as AT_DESK_TIMES'
+    return datetime.fromtimestamp(t, timezone.utc).replace(tzinfo=None)
+
+
+class HysteresisSmoother(object):
+    '''
+    Streaming hysteresis filter with O(1) cost per window. Windows must be
+    pushed in time order. A gap longer than max_gap seconds between two
+    windows ends the open session at the end of the last window.
+    '''
+
+    def __init__(self, enter_thresh=ENTER_THRESH, exit_thresh=EXIT_THRESH,
+                 enter_wins=ENTER_WINS, exit_wins=EXIT_WINS,
+                 t_win=WIN_SIZE, max_gap=None):
+        if exit_thresh > enter_thresh:
+            raise ValueError('exit_thresh is above enter_thresh.')
+        if enter_wins < 1 or exit_wins < 1:
+            raise ValueError('enter_wins and exit_wins must be at least 1.')
+        self.enter_thresh = enter_thresh
+        self.exit_thresh = exit_thresh
+        self.enter_wins = enter_wins
+        self.exit_wins = exit_wins
+        self.t_win = t_win
+        self.max_gap = t_win if max_gap is None else max_gap
+        self.reset()
+
+    def reset(self):
+        'Drops the open session and the pending windows'
+        self.at_desk = False
+        self._start = None      # start of the open or pending session
+        self._end = None        # end of the last window at desk
+        self._run = 0           # consecutive windows against the state
+        self._last_ts = None
+
+    def update(self, ts, prob):
+        '''
+        param:
+            ts: start timestamp of the window
+            prob: at desk probability of the window
+        Return:
+            list of the (start, end) timestamps of the sessions closed by
+            this window, usually empty
+        '''
+        closed = list()
+        if self._last_ts is not None and ts - self._last_ts > self.max_gap:
+            closed.extend(self.flush())
+        self._last_ts = ts
+
+        if not self.at_desk:
+            if prob >= self.enter_thresh:
+                if self._run == 0:
+                    self._start = ts
+                self._run += 1
+                self._end = ts + self.t_win
+                if self._run >= self.enter_wins:
+                    self.at_desk = True
+                    self._run = 0
+            else:
+                self._run = 0
+        else:
+            if prob <= self.exit_thresh:
+                self._run += 1
+                if self._run >= self.exit_wins:
+                    closed.append((self._start, self._end))
+                    self.at_desk = False
+                    self._run = 0
+            else:
+                self._run = 0
+                self._end = ts + self.t_win
+        return closed
+
+    def flush(self):
+        '''
+        Ends the open session, e.g. at the end of a day or a stream.
+        Returns a list with its (start, end) timestamps, or an empty list.
+        '''
+        closed = list()
+        if self.at_desk:
+            closed.append((self._start, self._end))
+        self.reset()
+        return closed
+
+
+def smooth_intervals(win_ts: np.ndarray, probs: np.ndarray, **kwargs) -> list:
+    '''
+    Batch version of HysteresisSmoother over the time ordered window start
+    timestamps and probabilities of one user. kwargs go to the smoother.
+    Returns the at desk sessions as (start, end) naive UTC datetimes, the
+    same form as AT_DESK_TIMES.
+    '''
+    smoother = HysteresisSmoother(**kwargs)
+    intervals = list()
+    for ts, prob in zip(win_ts.tolist(), probs.tolist()):
+        intervals.extend(smoother.update(ts, prob))
+    intervals.extend(smoother.flush())
+    return [(to_datetime(start_t), to_datetime(end_t))
+            for start_t, end_t in intervals]
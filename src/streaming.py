@@ -0,0 +1,132 @@
+'''
+This module provides online feature extraction over incoming sensor chunks.
+'''
+from collections import OrderedDict
+
+import numpy as np
+
+# Local application/library specific imports.
+import feature_extraction
+import sensors
+import utils
+
+# Buffer columns: ts, offset, then the sample fields of every sensor
+TS_COL = 0
+OFFSET_COL = 1
+
+
+def buffer_layout(sensor_cols=None):
+    '''
+    Returns the buffer column slice of every sensor and the number of buffer
+    columns. sensor_cols maps every buffered sensor to its number of leading
+    sample fields, and defaults to the fields read by the feature sets of
+    sensors.feature_sensors().
+    '''
+    if sensor_cols is None:
+        sensor_cols = OrderedDict((name, sensors.feature_set(name).n_cols)
+                                  for name in sensors.feature_sensors())
+    cols = OrderedDict()
+    col = OFFSET_COL + 1
+    for name, n_cols in sensor_cols.items():
+        cols[name] = slice(col, col + n_cols)
+        col += n_cols
+    return cols, col
+
+
+class StreamingFeatureExtractor(object):
+    '''
+    Incremental version of the per day feature extraction in
+    feature_extraction.py. Sensor chunks on the INTERP_FREQ grid are pushed
+    as they arrive and a feature vector is emitted as soon as a window
+    closes. Only the samples of the current window are kept, so memory
+    does not grow with the length of the stream.
+    '''
+
+    def __init__(self, sample_freq=utils.INTERP_FREQ,
+                 t_win=feature_extraction.WIN_SIZE,
+                 overlap=feature_extraction.OVERLAP, outlier_mode='clip',
+                 sensor_cols=None):
+        self.outlier_mode = outlier_mode
+        self.win_len = int(sample_freq * t_win)
+        self.overlap_len = int(sample_freq * overlap * t_win)
+        if self.overlap_len >= self.win_len:
+            raise ValueError('overlap is larger than or equal to output '
+                             'window length.')
+        self.cols, num_cols = buffer_layout(sensor_cols)
+        self._buf = np.empty((self.win_len, num_cols))
+        self._fill = 0
+
+    def reset(self):
+        '''
+        Drops the partially filled window, e.g. after a gap in the stream.
+        '''
+        self._fill = 0
+
+    def push_windows(self, ts, offset, sensor_data):
+        '''
+        param:
+            ts, offset: 1D arrays of n samples
+            sensor_data: dict of the n x n_fields (or n) samples of every
+                buffered sensor, fields past the buffered ones are ignored
+        Return:
+            (ts windows, dict of sensor windows) of the windows closed by
+            this chunk, n_windows x win_len and n_windows x win_len x n_cols
+            arrays with no rows if no window closed
+        '''
+        n_samples = ts.shape[0]
+        chunk = np.empty((n_samples, self._buf.shape[1]))
+        chunk[:, TS_COL] = ts
+        chunk[:, OFFSET_COL] = offset
+        for name, cols in self.cols.items():
+            if name not in sensor_data:
+                raise ValueError('%s samples are missing.' % name)
+            x = np.asarray(sensor_data[name], dtype=np.float64)
+            x = x.reshape((n_samples, -1))
+            n_cols = cols.stop - cols.start
+            if x.shape[1] < n_cols:
+                raise ValueError('%s samples have %d fields, %d expected.'
+                                 % (name, x.shape[1], n_cols))
+            chunk[:, cols] = x[:, :n_cols]
+
+        wins = list()
+        i = 0
+        while i < chunk.shape[0]:
+            n = min(self.win_len - self._fill, chunk.shape[0] - i)
+            self._buf[self._fill:self._fill + n] = chunk[i:i + n]
+            self._fill += n
+            i += n
+            if self._fill == self.win_len:
+                wins.append(self._buf.copy())
+                # Keep the overlapping tail as the head of the next window
+                step = self.win_len - self.overlap_len
+                self._buf[:self.overlap_len] = self._buf[step:]
+                self._fill = self.overlap_len
+
+        if wins:
+            wins = np.stack(wins)
+        else:
+            wins = np.empty((0,) + self._buf.shape)
+        return (wins[:, :, TS_COL],
+                {name: wins[:, :, cols] for name, cols in self.cols.items()})
+
+    def push(self, ts, offset, sensor_data):
+        '''
+        param:
+            ts, offset: 1D arrays of n samples
+            sensor_data: dict of the n x n_fields (or n) samples of every
+                sensor of sensors.feature_sensors()
+        Return:
+            (start timestamps, feature matrix) of the windows closed by this
+            chunk. The feature matrix has the same columns as the per day
+            feature matrix and no rows if no window closed. Windows dropped
+            by the outlier mode are left out of both.
+        '''
+        ts_wins, sensor_wins = self.push_windows(ts, offset, sensor_data)
+        if not ts_wins.shape[0]:
+            return np.empty(0), np.empty((0, 0))
+        # Offset windows are taken from ts, same as time_features().
+        feat_mat = feature_extraction.window_features(ts_wins, ts_wins,
+                                                      sensor_wins)
+        feat_mat, keep, _ = feature_extraction.feature_outlier_policy(
+            feat_mat, self.outlier_mode)
+        return ts_wins[keep, 0], feat_mat
@@ -1,12 +1,20 @@
 '''
 This module contains utility constatns and helper functions.
 '''
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
 from datetime import timedelta, datetime
+from itertools import chain, islice
 from typing import List
+import os
+import time
+import traceback
 
 import numpy as np
 from cerebralcortex.core.datatypes.datastream import DataPoint
 
+from cache import FileCache
+
 
 # Sensor sample range
 MAX_ACCEL = 5.0
@@ -61,6 +69,12 @@ MIN_STEP_CNT = 0
 
 INTERP_FREQ = 20.0 # 20.0 HZ
 
+# Rows per array yielded by iter_numpy_chunks()
+CHUNK_SIZE = 100000
+
+# Threads fetching stream days in export_stream()
+EXPORT_WORKERS = 8
+
 
 def extract_matched_labels(labels: List, keywords: List)->List:
     """
@@ -99,11 +113,101 @@ def extract_all_data(CC, usr_id: str, stream_label: str)->List[DataPoint]:
     return data
 
 
+def merge_sorted(blocks: List[np.ndarray]) -> np.ndarray:
+    """
+    Merge arrays already sorted by their first column into one sorted array.
+    Blocks are merged pairwise with searchsorted, rows of earlier blocks
+    first on equal timestamps.
+    """
+    blocks = [block for block in blocks if block.shape[0]]
+    if not blocks:
+        return np.empty((0, 0))
+    while len(blocks) > 1:
+        merged = list()
+        for i in range(0, len(blocks) - 1, 2):
+            a, b = blocks[i], blocks[i + 1]
+            # Output row of every row of b, rows of a fill the rest
+            pos_b = (np.searchsorted(a[:, 0], b[:, 0], side='right')
+                     + np.arange(b.shape[0]))
+            out = np.empty((a.shape[0] + b.shape[0], a.shape[1]))
+            is_b = np.zeros(out.shape[0], dtype=bool)
+            is_b[pos_b] = True
+            out[pos_b] = b
+            out[~is_b] = a
+            merged.append(out)
+        if len(blocks) % 2:
+            merged.append(blocks[-1])
+        blocks = merged
+    return blocks[0]
+
+
+def stream_day_array(CC, usr_id: str, stream_id, stream_day: str,
+                     width: int = None, validate=None) -> np.ndarray:
+    """
+    Fetch one stream day and convert it with to_numpy_array(), sorted by
+    start time. validate is an optional validation.validate_* function.
+    """
+    data = CC.get_stream(stream_id, usr_id, stream_day).data
+    if validate is not None:
+        data = validate(data)
+    if not data:
+        return np.empty((0, 0))
+    block = to_numpy_array(data, width)
+    if np.any(block[1:, 0] < block[:-1, 0]):
+        block = block[np.argsort(block[:, 0], kind='stable')]
+    return block
+
+
+def export_stream(CC, usr_id: str, stream_label: str, fn_prefix: str = None,
+                  days: List[str] = None, width: int = None, validate=None,
+                  max_workers: int = EXPORT_WORKERS) -> np.ndarray:
+    """
+    Array version of extract_all_data(). Stream days are fetched by a pool
+    of max_workers threads and converted to arrays as they arrive. When
+    fn_prefix is given, every day is saved to fn_prefix<day>.npz as soon
+    as all of its stream ids are fetched. days limits the export to these
+    stream days.
+    Returns the sorted array of all days.
+    """
+    usr_streams = CC.get_user_streams(usr_id)
+    try:
+        target_stream = usr_streams[stream_label]
+    except KeyError:
+        print(usr_id + " does not have stream " + stream_label)
+        return np.empty((0, 0))
+
+    tasks = [(stream_id, stream_day)
+             for stream_id in target_stream['stream_ids']
+             for stream_day in CC.get_stream_days(stream_id)
+             if days is None or stream_day in days]
+    pending = dict()
+    for _, stream_day in tasks:
+        pending[stream_day] = pending.get(stream_day, 0) + 1
+
+    day_blocks = dict()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(stream_day_array, CC, usr_id, stream_id,
+                                   stream_day, width, validate): stream_day
+                   for stream_id, stream_day in tasks}
+        for future in as_completed(futures):
+            stream_day = futures[future]
+            day_blocks.setdefault(stream_day, list()).append(future.result())
+            pending[stream_day] -= 1
+            if pending[stream_day] == 0:
+                day_blocks[stream_day] = merge_sorted(day_blocks[stream_day])
+                if fn_prefix is not None and day_blocks[stream_day].shape[0]:
+                    np.savez(fn_prefix + stream_day, day_blocks[stream_day])
+
+    return merge_sorted([day_blocks[stream_day]
+                         for stream_day in sorted(day_blocks)])
+
+
 
 def fill_missing_values(datapoints: List[DataPoint], freq: float) -> List[DataPoint]:
     
     """
-    Introperlate the datapoints based on assigned frequency.
+    Introperlate the datapoints based on assigned frequency. Every new
+    timestamp repeats the latest datapoint at or before it.
     """
     
     if not datapoints:
@@ -112,30 +216,54 @@ def fill_missing_values(datapoints: List[DataPoint], freq: float) -> List[DataPo
         return datapoints
     
     # Convert frequency to time intveral in second.
-    time_interval = 1.0/freq
-    new_datapoints = list()
+    time_step = timedelta(seconds=1.0/freq)
     start_t  = datapoints[0].start_time
     end_t = datapoints[-1].start_time
     
-    # Create a new list of timestamps with adjacent timestamp separated by time_invertal.
-    t = start_t
-    new_ts = list()
-    
-    # Interpolate the data list
-    while t <= end_t:
-        new_ts.append(t)
-        t += timedelta(seconds=time_interval)
-    #print(start_t, end_t)
-    #print('# of new dp:', len(new_ts))
-
-    j = 0
-    for i in range(len(new_ts)):
-        if new_ts[i] >= datapoints[j].start_time:
-            new_datapoints.append(DataPoint(new_ts[i], None, datapoints[j].offset, datapoints[j].sample))
-            j += 1
-        else:
-            new_datapoints.append(DataPoint(new_ts[i], None, datapoints[j-1].offset, datapoints[j-1].sample))
-    return new_datapoints
+    # New timestamps are start_t + k * time_step up to end_t
+    n_new = (end_t - start_t) // time_step + 1
+    steps = np.fromiter(((dp.start_time - start_t) / time_step
+                         for dp in datapoints),
+                        dtype=np.float64, count=len(datapoints))
+    idx = np.searchsorted(steps, np.arange(n_new), side='right') - 1
+
+    return [DataPoint(start_t + k * time_step, None,
+                      datapoints[j].offset, datapoints[j].sample)
+            for k, j in enumerate(idx.tolist())]
+
+
+def fill_missing_array(ts: np.ndarray, samples: np.ndarray, freq: float,
+                       max_gap: float = None):
+    """
+    Array version of fill_missing_values(). Resamples samples (n or n x k)
+    taken at the sorted timestamps ts onto a grid of freq from ts[0] to
+    ts[-1], holding the latest sample at or before every grid timestamp.
+    Grid timestamps whose held sample is more than max_gap seconds old are
+    marked missing with NaN.
+    Returns (grid timestamps, grid samples, gaps), gaps being an m x 2
+    array of the start timestamp and length in seconds of every interval
+    between samples longer than 1/freq. Empty input gives empty outputs.
+    """
+    if freq <= 0.0:
+        raise ValueError('freq must be positive.')
+    if not ts.shape[0]:
+        return (np.empty(0), np.empty(samples.shape, dtype=np.float64),
+                np.empty((0, 2)))
+    time_interval = 1.0/freq
+    # Tolerance for the float error of epoch timestamps
+    tol = 1e-3 * time_interval
+    n_new = int(np.floor((ts[-1] - ts[0] + tol) * freq)) + 1
+    ts_new = ts[0] + np.arange(n_new) * time_interval
+
+    idx = np.searchsorted(ts, ts_new, side='right') - 1
+    samples_new = np.take(samples, idx, axis=0).astype(np.float64)
+    if max_gap is not None:
+        samples_new[ts_new - ts[idx] > max_gap] = np.nan
+
+    intervals = np.diff(ts)
+    is_gap = intervals > time_interval + tol
+    gaps = np.column_stack((ts[:-1][is_gap], intervals[is_gap]))
+    return ts_new, samples_new, gaps
 
 
 def dp_to_list(dp: DataPoint)-> List:
@@ -159,24 +287,67 @@ def dp_to_list(dp: DataPoint)-> List:
     return result
     
 
-def to_numpy_array(datapoints: List[DataPoint]):
+def to_numpy_array(datapoints: List[DataPoint], width: int = None):
+    """
+    Convert a list of DataPoints to an n x (3 + width) float64 numpy array
+    of start time, end time, offset and sample fields, same as dp_to_list()
+    for every DataPoint. width defaults to the sample length of the first
+    DataPoint. Missing start or end times are NaN.
+    """
+    n = len(datapoints)
+    if width is None:
+        width = len(datapoints[0].sample) if n else 0
+    result = np.empty((n, 3 + width))
+    if not n:
+        return result
+
+    result[:, 0] = np.fromiter(
+        (np.nan if dp.start_time is None else dp.start_time.timestamp()
+         for dp in datapoints), dtype=np.float64, count=n)
+    result[:, 1] = np.fromiter(
+        (np.nan if dp.end_time is None else dp.end_time.timestamp()
+         for dp in datapoints), dtype=np.float64, count=n)
+    result[:, 2] = np.fromiter((dp.offset for dp in datapoints),
+                               dtype=np.float64, count=n)
+    samples = np.fromiter(chain.from_iterable(dp.sample for dp in datapoints),
+                          dtype=np.float64)
+    if samples.shape[0] != n * width:
+        raise ValueError('DataPoint samples do not all have %d fields.'
+                         % width)
+    result[:, 3:] = samples.reshape((n, width))
+    return result
+
+
+def iter_numpy_chunks(datapoints, chunk_size: int = CHUNK_SIZE,
+                      width: int = None):
     """
-    Convert a list of DataPoints to numpy array.
+    Generator version of to_numpy_array() over any iterable of DataPoints.
+    Yields arrays of up to chunk_size rows, so a long stream is never held
+    as one list. width defaults to the sample length of the first DataPoint.
     """
-    data = [dp_to_list(dp) for dp in datapoints]
-    return np.array(data)
+    it = iter(datapoints)
+    while True:
+        chunk = list(islice(it, chunk_size))
+        if not chunk:
+            return
+        if width is None:
+            width = len(chunk[0].sample)
+        yield to_numpy_array(chunk, width)
 
 
 
-def generate_wins(seq: np.ndarray, length: int, overlap: int):
+def generate_wins(seq: np.ndarray, length: int, overlap: int, view: bool = False):
     '''
     param:
-	seq: 1D numpy array
+	seq: 1D numpy array, or n_samples x n_channels array when view is True
         legnth: output window length
         overlap: number of overlaped samples in output windows
+        view: return a read-only strided view over seq instead of a copy
     Return
         an array of output windows
     '''
+    if view:
+        return strided_wins(seq, length, overlap)
     if len(seq.shape) != 1:
         print('is not 1D array')
         return None
@@ -198,6 +369,49 @@ def generate_wins(seq: np.ndarray, length: int, overlap: int):
 
     return results
 
+
+def strided_wins(seq: np.ndarray, length: int, overlap: int):
+    '''
+    Zero-copy version of generate_wins.
+    param:
+        seq: n_samples or n_samples x n_channels numpy array
+        legnth: output window length
+        overlap: number of overlaped samples in output windows
+    Return
+        a read-only view of shape n_windows x length (x n_channels) sharing
+        memory with seq. Unlike generate_wins, a seq shorter than length
+        gives zero windows and a seq of exactly length samples one window.
+    '''
+    if len(seq.shape) not in (1, 2):
+        print('is not 1D or 2D array')
+        return None
+    if overlap >= length:
+        print('overlap is larger than or equal to output window length.')
+        return None
+
+    step = length - overlap
+    n_wins = max((seq.shape[0] - length) // step + 1, 0)
+    shape = (n_wins, length) + seq.shape[1:]
+    strides = (seq.strides[0] * step,) + seq.strides
+    return np.lib.stride_tricks.as_strided(seq, shape=shape, strides=strides,
+                                           writeable=False)
+
+def window_fractions(seq: np.ndarray, length: int, overlap: int):
+    '''
+    Returns the mean of every window strided_wins would output for a 1D
+    0/1 label sequence, i.e. the fraction of positive labels per window.
+    '''
+    if len(seq.shape) != 1:
+        print('is not 1D array')
+        return None
+    if overlap >= length:
+        print('overlap is larger than or equal to output window length.')
+        return None
+
+    sums = np.concatenate(([0.0], np.cumsum(seq, dtype=np.float64)))
+    starts = np.arange(0, seq.shape[0] - length + 1, length - overlap)
+    return (sums[starts + length] - sums[starts]) / length
+
 # def split_windows(wins, length, overlap=0):
 #     '''
 #     param:
@@ -211,3 +425,83 @@ def generate_wins(seq: np.ndarray, length: int, overlap: int):
 #     for win in wins:
 #         results.append(split_window(win, length, overlap))
 #     return np.concatenate(results)
+
+
+def add_driver_arguments(parser, cache_help: str):
+    """
+    Add the --workers, --cache-dir and --cache-size arguments of the per
+    user day drivers to an argparse parser.
+    """
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--cache-dir', help=cache_help)
+    parser.add_argument('--cache-size', type=float, default=10.0,
+                        help='cache size limit in GB')
+
+
+def open_cache(args):
+    """
+    Return the FileCache of the --cache-dir argument, evicted down to
+    --cache-size, or None without a cache directory.
+    """
+    if not args.cache_dir:
+        return None
+    cache = FileCache(args.cache_dir, int(args.cache_size * 1e9))
+    cache.evict()
+    return cache
+
+
+def run_day_task(func, usr_id: str, day: str, args: tuple, cache=None):
+    """
+    Run func(usr_id, day, *args, cache=cache) in a worker process. Errors
+    are caught and returned, so one corrupt day does not stop the others.
+    Return (usr_id, day, elapsed seconds, result or None, error message or
+    None, (cache hits, cache misses)).
+    """
+    start = time.time()
+    try:
+        result = func(usr_id, day, *args, cache=cache)
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+    cache_stats = (0, 0)
+    if cache is not None:
+        cache_stats = (cache.hits, cache.misses)
+    return usr_id, day, time.time() - start, result, error, cache_stats
+
+
+def run_day_tasks(func, tasks: List[tuple], workers: int, cache=None):
+    """
+    Run func over every (usr_id, day, args) of tasks in a pool of worker
+    processes with run_day_task(), printing the outcome of every day.
+    Return a dict of the results by (usr_id, day).
+    """
+    start = time.time()
+    results = dict()
+    failed = list()
+    cache_hits = 0
+    cache_misses = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_day_task, func, usr_id, day, args,
+                                   cache)
+                   for usr_id, day, args in tasks]
+        for future in as_completed(futures):
+            usr_id, day, elapsed, result, error, cache_stats = future.result()
+            cache_hits += cache_stats[0]
+            cache_misses += cache_stats[1]
+            if error is None:
+                print('%s %s done in %.1fs' % (usr_id, day, elapsed))
+                results[(usr_id, day)] = result
+            else:
+                print('%s %s failed in %.1fs' % (usr_id, day, elapsed))
+                print(error)
+                failed.append((usr_id, day))
+
+    if cache is not None:
+        print('Cache: %d hit(s), %d miss(es)' % (cache_hits, cache_misses))
+    print('Processed %d user days in %.1fs, %d failed'
+          % (len(tasks), time.time() - start, len(failed)))
+    for usr_id, day in failed:
+        print('Failed: ' + usr_id + ' ' + day)
+    return results
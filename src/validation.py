@@ -3,54 +3,40 @@ This module provides functions to do data validation check.
 '''
 import numbers
 from typing import List
+import numpy as np
 from cerebralcortex.core.datatypes.datastream import DataPoint
-import utils
+import sensors
 
-def is_valid_phone_accelerometer(datapoint: DataPoint):
+def is_valid_sample(datapoint: DataPoint, sensor: str):
     '''
-    Return True if input data point is a valid phone accelerometer data point.
+    Return True if the sample of the data point has the fields of the sensor
+    in sensors.SENSORS, each a real number within its bounds.
     Otherwise return False.
     '''
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 3:
+    fields = sensors.SENSORS[sensor].fields
+    if (not isinstance(datapoint.sample, List)
+            or len(datapoint.sample) != len(fields)):
         return False
-    val = datapoint.sample[0]
-    valid_x = (isinstance(val, numbers.Real)
-               and val >= utils.MIN_ACCEL
-               and val <= utils.MAX_ACCEL)
-    val = datapoint.sample[1]
-    valid_y = (isinstance(val, numbers.Real)
-               and val >= utils.MIN_ACCEL
-               and val <= utils.MAX_ACCEL)
-    val = datapoint.sample[2]
-    valid_z = (isinstance(val, numbers.Real)
-               and val >= utils.MIN_ACCEL
-               and val <= utils.MAX_ACCEL)
-
-    return valid_x and valid_y and valid_z
+    return all(isinstance(val, numbers.Real)
+               and val >= field.min
+               and val <= field.max
+               for val, field in zip(datapoint.sample, fields))
 
 
-def is_valid_phone_gyroscope(datapoint: DataPoint):
+def is_valid_phone_accelerometer(datapoint: DataPoint):
     '''
     Return True if input data point is a valid phone accelerometer data point.
     Otherwise return False.
     '''
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 3:
-        return False
+    return is_valid_sample(datapoint, 'accel')
 
-    val = datapoint.sample[0]
-    valid_x = (isinstance(val, numbers.Real)
-               and val >= utils.MIN_GYRO
-               and val <= utils.MAX_GYRO)
-    val = datapoint.sample[1]
-    valid_y = (isinstance(val, numbers.Real)
-               and val >= utils.MIN_GYRO
-               and val <= utils.MAX_GYRO)
-    val = datapoint.sample[2]
-    valid_z = (isinstance(val, numbers.Real)
-               and val >= utils.MIN_GYRO
-               and val <= utils.MAX_GYRO)
 
-    return valid_x and valid_y and valid_z
+def is_valid_phone_gyroscope(datapoint: DataPoint):
+    '''
+    Return True if input data point is a valid phone gyroscope data point.
+    Otherwise return False.
+    '''
+    return is_valid_sample(datapoint, 'gyro')
 
 
 def is_valid_phone_location(datapoint: DataPoint):
@@ -58,40 +44,7 @@ def is_valid_phone_location(datapoint: DataPoint):
     Return True if input data point is a valid phone location data point.
     Otherwise return False.
     '''
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 6:
-        return False
-
-    val = datapoint.sample[0]
-    valid_lat = (isinstance(val, numbers.Real)
-                 and val >= utils.MIN_LOC_LAT
-                 and val <= utils.MAX_LOC_LAT)
-    val = datapoint.sample[1]
-    valid_lon = (isinstance(val, numbers.Real)
-                 and val >= utils.MIN_LOC_LON
-                 and val <= utils.MAX_LOC_LON)
-    val = datapoint.sample[2]
-    valid_alt = (isinstance(val, numbers.Real)
-                 and val >= utils.MIN_LOC_ALT
-                 and val <= utils.MAX_LOC_ALT)
-    val = datapoint.sample[3]
-    valid_speed = (isinstance(val, numbers.Real)
-                   and val >= utils.MIN_LOC_SPEED
-                   and val <= utils.MAX_LOC_SPEED)
-    val = datapoint.sample[4]
-    valid_bearing = (isinstance(val, numbers.Real)
-                     and val >= utils.MIN_LOC_BEAR
-                     and val <= utils.MAX_LOC_BEAR)
-    val = datapoint.sample[5]
-    valid_accuracy = (isinstance(val, numbers.Real)
-                      and val >= utils.MIN_LOC_ACCUR
-                      and val <= utils.MAX_LOC_ACCUR)
-
-    return (valid_lat
-            and valid_lon
-            and valid_alt
-            and valid_speed
-            and valid_bearing
-            and valid_accuracy)
+    return is_valid_sample(datapoint, 'location')
 
 
 def is_valid_phone_activity_type(datapoint: DataPoint):
@@ -99,18 +52,7 @@ def is_valid_phone_activity_type(datapoint: DataPoint):
     Return True if input data point is a valid phone activity type data point.
     Otherwise return False.
     '''
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 2:
-        return False
-    val = datapoint.sample[0]
-    valid_type = (isinstance(val, numbers.Real)
-                  and val >= utils.MIN_ACT_TYPE
-                  and val <= utils.MAX_ACT_TYPE)
-    val = datapoint.sample[1]
-    valid_confidence = (isinstance(val, numbers.Real)
-                        and val >= utils.MIN_CONFIDENCE
-                        and val <= utils.MAX_CONFIDENCE)
-
-    return valid_type and valid_confidence
+    return is_valid_sample(datapoint, 'act_type')
 
 
 def is_valid_phone_ambient_light(datapoint: DataPoint):
@@ -118,13 +60,7 @@ def is_valid_phone_ambient_light(datapoint: DataPoint):
     Return True if input data point is a valid phone ambient light data point.
     Otherwise return False.
     '''
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 1:
-        return False
-
-    val = datapoint.sample[0]
-    return (isinstance(val, numbers.Real)
-            and val >= utils.MIN_LIGHT_INTENSITY
-            and val <= utils.MAX_LIGHT_INTENSITY)
+    return is_valid_sample(datapoint, 'light')
 
 
 def is_valid_phone_proximity(datapoint: DataPoint):
@@ -132,13 +68,7 @@ def is_valid_phone_proximity(datapoint: DataPoint):
     Return True if input data point is a valid phone proximity data point.
     Otherwise return False.
     '''
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 1:
-        return False
-
-    val = datapoint.sample[0]
-    return (isinstance(val, numbers.Real)
-            and val >= utils.MIN_PROXIMITY
-            and val <= utils.MAX_PROXIMITY)
+    return is_valid_sample(datapoint, 'proximity')
 
 
 def is_valid_phone_battery(datapoint: DataPoint):
@@ -146,22 +76,7 @@ def is_valid_phone_battery(datapoint: DataPoint):
     Return True if input data point is a valid phone battery data point.
     Otherwise return False.
     '''
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 3:
-        return False
-    val = datapoint.sample[0]
-    valid_level = (isinstance(val, numbers.Real)
-                   and val >= utils.MIN_BATT_LEVEL
-                   and val <= utils.MAX_BATT_LEVEL)
-    val = datapoint.sample[1]
-    valid_volt = (isinstance(val, numbers.Real)
-                  and val >= utils.MIN_BATT_VOLT
-                  and val <= utils.MAX_BATT_VOLT)
-    val = datapoint.sample[2]
-    valid_temp = (isinstance(val, numbers.Real)
-                  and val >= utils.MIN_BATT_TEMP
-                  and val <= utils.MAX_BATT_TEMP)
-
-    return valid_level and valid_volt and valid_temp
+    return is_valid_sample(datapoint, 'battery')
 
 
 def is_valid_beacon(datapoint: DataPoint):
@@ -169,34 +84,26 @@ def is_valid_beacon(datapoint: DataPoint):
     Return True if input data point is a valid beacon data point.
     Otherwise return False.
     '''
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 3:
-        return False
+    return is_valid_sample(datapoint, 'beacon')
 
-    val = datapoint.sample[0]
-    valid_dis = (isinstance(val, numbers.Real)
-                 and val >= utils.MIN_BLE_DIS
-                 and val <= utils.MAX_BLE_DIS)
-    val = datapoint.sample[1]
-    valid_rssi = (isinstance(val, numbers.Real)
-                  and val >= utils.MIN_BLE_RSSI
-                  and val <= utils.MAX_BLE_RSSI)
-    val = datapoint.sample[2]
-    valid_tx = (isinstance(val, numbers.Real)
-                and val >= utils.MIN_BLE_TX
-                and val <= utils.MAX_BLE_TX)
 
-    return valid_dis and valid_rssi and valid_tx
+def is_valid_step_count(datapoint: DataPoint):
+    '''
+    Return True if input data point is a valid step count data point.
+    Otherwise return False.
+    '''
+    return is_valid_sample(datapoint, 'step_cnt')
 
 
-def is_valid_step_count(datapoint: DataPoint):
-    if not isinstance(datapoint.sample, List) or len(datapoint.sample) != 1:
-        return False
-    
-    val = datapoint.sample[0]
-    valid_cnt = (isinstance(val, numbers.Real)
-                 and val >= utils.MIN_STEP_CNT
-                 and val <= utils.MAX_STEP_CNT)
-    return valid_cnt
+def validate_sensor(data: List[DataPoint], sensor: str) -> List[DataPoint]:
+    '''
+    validate the data stream of any sensor in sensors.SENSORS
+    :param data:
+    :param sensor: key of sensors.SENSORS
+    :return: valid_data
+    '''
+    return [datapoint for datapoint in data
+            if is_valid_sample(datapoint, sensor)]
 
 
 def validate_location(loc_data: List[DataPoint]) -> List[DataPoint]:
@@ -322,4 +229,36 @@ def validate_gyroscope(gyro_data: List[DataPoint]) -> List[DataPoint]:
         if is_valid_phone_gyroscope(datapoint):
             valid_gyro_data.append(datapoint)
 
-    return valid_gyro_data
\ No newline at end of file
+    return valid_gyro_data
+
+
+# (field, min, max) of every sample field in order, per sensor
+SENSOR_BOUNDS = {name: [(field.name, field.min, field.max)
+                        for field in sensor.fields]
+                 for name, sensor in sensors.SENSORS.items()}
+
+
+def validate_array(samples: np.ndarray, sensor: str):
+    '''
+    Vectorized version of the is_valid_* checks over an n x k array of
+    samples, e.g. the sensors.sample_cols() columns of utils.to_numpy_array().
+    NaN fields are rejected.
+    :param samples: n x k sample array, k fields in SENSOR_BOUNDS order
+    :param sensor: key of SENSOR_BOUNDS
+    :return: (boolean mask of valid samples, dict of rejected count per field)
+    '''
+    bounds = SENSOR_BOUNDS[sensor]
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.ndim == 1:
+        samples = samples.reshape((-1, 1))
+    if samples.shape[1] != len(bounds):
+        raise ValueError('%s samples have %d fields, %d expected.'
+                         % (sensor, samples.shape[1], len(bounds)))
+
+    lo = np.array([b[1] for b in bounds], dtype=np.float64)
+    hi = np.array([b[2] for b in bounds], dtype=np.float64)
+    # NaN compares False on both sides, so it is never in bounds
+    in_bounds = (samples >= lo) & (samples <= hi)
+    mask = np.all(in_bounds, axis=1)
+    rejected = samples.shape[0] - np.count_nonzero(in_bounds, axis=0)
+    return mask, {b[0]: int(n) for b, n in zip(bounds, rejected)}